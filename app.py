@@ -1,10 +1,13 @@
 import os
+import base64
 import logging
+import zipfile
 from datetime import datetime
 
 from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, session
 from flask_socketio import SocketIO, emit
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import update
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -58,8 +61,47 @@ with app.app_context():
     # Import utility modules
     from utils.sms import send_sms_notification
     from utils.qr_code import generate_qr_code
-    from utils.blockchain import create_trust_id
-    from utils.ai import analyze_complaint_risk
+    from utils.blockchain import (get_blockchain, verify_trust_ids, start_background_audit,
+                                  submit_trust_id, get_receipt, add_receipt_callback,
+                                  anchor_fine, fine_transaction, fine_reference, get_record_proof,
+                                  get_transaction_pool, anchor_missing_records,
+                                  anchored_up_to, mark_anchored_up_to,
+                                  hash_transaction, verify_merkle_proof)
+    from utils.ai import (score_complaint_risk, analyze_complaint_risk_batch, complaint_batcher,
+                          COMPLAINT_SCORE_MAX_TEXTS)
+    from utils.biometrics import (get_biometric_verifier, add_training_listener,
+                                  enrollment_items_from_zip, BULK_ENROLL_MAX_IMAGES)
+    from utils.resource_pool import PoolTimeout
+
+    # Load the Trust ID chain once; requests reuse the resident copy
+    get_blockchain()
+
+    # Seal transactions queued by workers that exited before their block was
+    # sealed, then anchor committed fines that still did not reach the ledger.
+    # Fines up to the persisted mark are known to be anchored and are skipped.
+    get_transaction_pool()
+    fines = (Fine.query.filter(Fine.id > anchored_up_to("fine"), Fine.blockchain_hash.isnot(None))
+             .order_by(Fine.id).all())
+    fine_records = []
+    for fine in fines:
+        record = fine_transaction(fine.id, fine.phone, fine.amount, fine.reason, fine.timestamp)
+        # Fines issued before ledger anchoring carry a mock hash
+        if fine_reference(record) == fine.blockchain_hash:
+            fine_records.append(record)
+    anchor_missing_records(fine_records)
+    if fines:
+        mark_anchored_up_to("fine", fines[-1].id)
+
+    # Confirm Trust IDs whose block was sealed but never reported back
+    for tid in TrustID.query.filter_by(ipfs_cid="pending").all():
+        receipt = get_receipt(tid.tid_hash)
+        if receipt and receipt["status"] == "confirmed":
+            tid.ipfs_cid = receipt["ipfs_cid"]
+    db.session.commit()
+
+    # Optional periodic full audit of the ledger (seconds between runs)
+    if os.environ.get("BLOCKCHAIN_AUDIT_INTERVAL"):
+        start_background_audit(float(os.environ["BLOCKCHAIN_AUDIT_INTERVAL"]))
 
 # Routes
 @app.route("/")
@@ -141,7 +183,7 @@ def complaints():
             return redirect(url_for("complaints"))
         
         # Analyze complaint risk using AI
-        risk_level = analyze_complaint_risk(message)
+        risk_level = score_complaint_risk(message)
         
         # Create and save complaint
         new_complaint = Complaint(
@@ -171,6 +213,45 @@ def complaints():
     return render_template("complaints.html", complaints=complaints_list)
 
 # Trust ID routes
+def queue_trust_id(phone, aadhaar=""):
+    """Save a Trust ID with a pending receipt and confirm it once mined"""
+    receipt = submit_trust_id(phone, aadhaar)
+    
+    # Save Trust ID; the IPFS CID is filled in when the block is sealed
+    new_tid = TrustID(
+        phone=phone,
+        tid_hash=receipt["tid_hash"],
+        ipfs_cid="pending",
+        created_at=datetime.now()
+    )
+    db.session.add(new_tid)
+    db.session.commit()
+    
+    add_receipt_callback(receipt["receipt_id"], on_trust_id_mined)
+    return receipt
+
+def on_trust_id_mined(receipt):
+    """Store the mined block reference and push it to connected clients"""
+    ipfs_cid = receipt.get("ipfs_cid", "error")
+    with app.app_context():
+        tid = TrustID.query.filter_by(tid_hash=receipt["tid_hash"]).first()
+        if tid:
+            tid.ipfs_cid = ipfs_cid
+            db.session.commit()
+            created_at = tid.created_at.isoformat()
+        else:
+            created_at = receipt["submitted_at"]
+    
+    socketio.emit('trust_id_update', {
+        'id': receipt["tid_hash"],
+        'phone': receipt["phone"],
+        'created_at': created_at,
+        'receipt_id': receipt["receipt_id"],
+        'status': receipt["status"],
+        'block_index': receipt.get("block_index"),
+        'ipfs_cid': ipfs_cid
+    })
+
 @app.route("/trust-id", methods=["GET", "POST"])
 def trust_id():
     if request.method == "POST":
@@ -187,20 +268,10 @@ def trust_id():
             flash("Trust ID already exists for this phone number", "warning")
             return redirect(url_for("trust_id"))
         
-        # Generate Trust ID using blockchain
-        tid_hash, ipfs_cid = create_trust_id(phone, aadhaar)
+        # Queue the Trust ID on the blockchain; mining happens in the background
+        queue_trust_id(phone, aadhaar)
         
-        # Save Trust ID
-        new_tid = TrustID(
-            phone=phone,
-            tid_hash=tid_hash,
-            ipfs_cid=ipfs_cid,
-            created_at=datetime.now()
-        )
-        db.session.add(new_tid)
-        db.session.commit()
-        
-        flash("Trust ID created successfully", "success")
+        flash("Trust ID created successfully. Blockchain confirmation is pending.", "success")
         return redirect(url_for("trust_id"))
     
     # GET request - display all Trust IDs
@@ -425,6 +496,62 @@ def verify_standing_zone():
     else:
         return jsonify({"status": "success", "valid": False})
 
+@app.route("/api/trust-id", methods=["POST"])
+def create_trust_id_api():
+    """Queue a Trust ID and return its pending receipt without waiting for mining"""
+    data = request.json
+    if not data or "phone" not in data:
+        return jsonify({"status": "error", "message": "Phone number is required"}), 400
+    
+    phone = data["phone"]
+    if TrustID.query.filter_by(phone=phone).first():
+        return jsonify({"status": "error", "message": "Trust ID already exists for this phone number"}), 409
+    
+    receipt = queue_trust_id(phone, data.get("aadhaar", ""))
+    return jsonify({"status": "success", "receipt": receipt}), 202
+
+@app.route("/api/trust-id/receipts/<receipt_id>")
+def trust_id_receipt(receipt_id):
+    """Look up the mining status of a Trust ID receipt"""
+    receipt = get_receipt(receipt_id)
+    if not receipt:
+        # Queued by another worker and not sealed yet; the Trust ID row is shared
+        tid = TrustID.query.filter_by(tid_hash=receipt_id).first()
+        if not tid:
+            return jsonify({"status": "error", "message": "Receipt not found"}), 404
+        receipt = {
+            "receipt_id": receipt_id,
+            "tid_hash": tid.tid_hash,
+            "phone": tid.phone,
+            "status": "failed" if tid.ipfs_cid == "error" else "pending",
+            "submitted_at": tid.created_at.isoformat()
+        }
+    return jsonify({"status": "success", "receipt": receipt})
+
+@app.route("/api/verify-trust-id", methods=["POST"])
+def verify_trust_id_api():
+    """Verify one Trust ID hash or a batch of them against the blockchain"""
+    data = request.json
+    if not data or ("tid_hash" not in data and "tid_hashes" not in data):
+        return jsonify({"status": "error", "message": "No Trust ID hash provided"}), 400
+    
+    tid_hashes = data["tid_hashes"] if "tid_hashes" in data else [data["tid_hash"]]
+    if not isinstance(tid_hashes, list) or not all(isinstance(h, str) for h in tid_hashes):
+        return jsonify({"status": "error", "message": "Trust ID hashes must be strings"}), 400
+    if len(tid_hashes) > 1000:
+        return jsonify({"status": "error", "message": "At most 1000 hashes per request"}), 400
+    
+    # Each hash is an index lookup, independent of chain length
+    found = verify_trust_ids(tid_hashes)
+    results = [
+        {"tid_hash": tid_hash, "valid": found[tid_hash] is not None, "block_index": found[tid_hash]}
+        for tid_hash in tid_hashes
+    ]
+    
+    if "tid_hashes" not in data:
+        return jsonify({"status": "success", **results[0]})
+    return jsonify({"status": "success", "results": results})
+
 @app.route("/api/log_verification", methods=["POST"])
 def log_verification():
     """Log TT verification activities"""
@@ -578,7 +705,7 @@ def submit_complaint():
     message = data["message"]
     
     # Analyze complaint risk
-    risk_level = analyze_complaint_risk(message)
+    risk_level = score_complaint_risk(message)
     
     # Create and save complaint
     new_complaint = Complaint(
@@ -612,6 +739,59 @@ def submit_complaint():
         "risk_level": risk_level
     })
 
+@app.route("/api/complaints/score", methods=["POST"])
+def score_complaints():
+    data = request.json
+    if not data or ("texts" not in data and not data.get("backfill")):
+        return jsonify({"status": "error", "message": "texts or backfill is required"}), 400
+    
+    # Re-score every stored complaint with the current model in one pass
+    if data.get("backfill"):
+        complaints = db.session.query(Complaint.id, Complaint.message, Complaint.risk_level).all()
+        try:
+            risk_levels = analyze_complaint_risk_batch([complaint.message for complaint in complaints])
+        except Exception as e:
+            # Nothing is written, so a broken model never overwrites stored risk levels
+            logger.error(f"Risk backfill aborted: {str(e)}")
+            return jsonify({"status": "error", "message": "Complaint scoring failed, nothing was updated"}), 500
+        changes = [
+            {"id": complaint.id, "risk_level": risk_level}
+            for complaint, risk_level in zip(complaints, risk_levels)
+            if complaint.risk_level != risk_level
+        ]
+        if changes:
+            # Bulk UPDATE by primary key, executed as one batch
+            db.session.execute(update(Complaint), changes)
+            db.session.commit()
+        logger.info(f"Backfilled risk levels: {len(changes)} of {len(complaints)} complaints changed")
+        return jsonify({
+            "status": "success",
+            "scored": len(complaints),
+            "updated": len(changes),
+            "high_risk": risk_levels.count("High")
+        })
+    
+    texts = data["texts"]
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"status": "error", "message": "texts must be a list of strings"}), 400
+    if len(texts) > COMPLAINT_SCORE_MAX_TEXTS:
+        return jsonify({"status": "error", "message": f"At most {COMPLAINT_SCORE_MAX_TEXTS} texts per request"}), 413
+    
+    try:
+        risk_levels = analyze_complaint_risk_batch(texts)
+    except Exception as e:
+        logger.error(f"Complaint scoring failed: {str(e)}")
+        return jsonify({"status": "error", "message": "Complaint scoring failed"}), 500
+    
+    return jsonify({
+        "status": "success",
+        "risk_levels": risk_levels
+    })
+
+@app.route("/api/complaints/metrics")
+def complaint_metrics():
+    return jsonify(complaint_batcher.stats())
+
 @app.route("/api/issue-fine", methods=["POST"])
 def issue_fine():
     data = request.json
@@ -628,12 +808,19 @@ def issue_fine():
         amount=amount,
         reason=reason,
         timestamp=datetime.now(),
-        status="issued",
-        blockchain_hash=f"0x{os.urandom(16).hex()}"  # Mock blockchain hash
+        status="issued"
     )
     db.session.add(new_fine)
+    db.session.flush()
+    
+    # The reference is the hash of the fine record, known before it is anchored
+    new_fine.blockchain_hash = fine_reference(
+        fine_transaction(new_fine.id, phone, amount, reason, new_fine.timestamp))
     db.session.commit()
     
+    # Only committed fines go to the ledger, in the next batched block
+    anchor_fine(new_fine.id, phone, amount, reason, new_fine.timestamp)
+    
     # Send fine notification
     try:
         send_sms_notification(
@@ -646,48 +833,129 @@ def issue_fine():
     return jsonify({
         "status": "success",
         "message": "Fine issued successfully",
-        "fine_id": new_fine.id
+        "fine_id": new_fine.id,
+        "blockchain_hash": new_fine.blockchain_hash
     })
 
+@app.route("/api/fines/<int:fine_id>/proof")
+def fine_proof(fine_id):
+    """Return the Merkle inclusion proof that anchors a fine in the ledger"""
+    fine = Fine.query.get(fine_id)
+    if not fine:
+        return jsonify({"status": "error", "message": "Fine not found"}), 404
+    if not fine.blockchain_hash:
+        return jsonify({"status": "success", "anchored": False, "message": "Fine was issued before ledger anchoring"})
+    
+    proof = get_record_proof(fine.blockchain_hash)
+    if not proof:
+        return jsonify({"status": "success", "anchored": False, "message": "Fine is waiting for the next block"})
+    
+    # The stored fine must still hash to the committed leaf
+    leaf = hash_transaction(fine_transaction(fine.id, fine.phone, fine.amount, fine.reason, fine.timestamp))
+    verified = f"0x{leaf}" == fine.blockchain_hash and verify_merkle_proof(leaf, proof["proof"], proof["merkle_root"])
+    
+    return jsonify({"status": "success", "anchored": True, "verified": verified, "proof": proof})
+
 # Facial verification route
 @app.route("/facial-verification")
 def facial_verification():
     return render_template("facial_verification.html")
 
-@app.route("/api/register-face", methods=["POST"])
-def register_face():
-    data = request.json
-    if not data or "phone" not in data or "image_data" not in data:
-        return jsonify({"success": False, "message": "Phone and image data are required"}), 400
-    
-    phone = data["phone"]
-    image_data = data["image_data"]
+def read_face_upload():
+    """Read the fields and image bytes of a face API request
+
+    The image can be sent as the raw request body (application/octet-stream
+    or image/*) with the other fields in the query string, as an 'image'
+    file in a multipart form, or as a base64 'image_data' data URL in JSON.
+
+    Returns:
+        tuple: (fields, image bytes or None)
+    """
+    if request.mimetype == "application/octet-stream" or request.mimetype.startswith("image/"):
+        return request.args, request.get_data(cache=False) or None
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("image")
+        return request.form, upload.read() if upload else None
+
+    data = request.get_json(silent=True) or {}
+    image_data = data.get("image_data")
+    if not image_data:
+        return data, None
     
     # Remove data URL prefix
     if image_data.startswith('data:image'):
         image_data = image_data.split(',')[1]
     
     # Convert base64 to binary
-    import base64
-    image_binary = base64.b64decode(image_data)
-    
-    # Import BiometricVerifier
-    from utils.biometrics import BiometricVerifier
+    try:
+        return data, base64.b64decode(image_data)
+    except ValueError:
+        return data, None
+
+@app.route("/api/register-face", methods=["POST"])
+def register_face():
+    data, image_binary = read_face_upload()
+    if "phone" not in data or not image_binary:
+        return jsonify({"success": False, "message": "Phone and image data are required"}), 400
     
-    # Create instance if not exists
-    if not hasattr(app, 'biometric_verifier'):
-        app.biometric_verifier = BiometricVerifier()
+    phone = data["phone"]
     
     # Register face
-    success = app.biometric_verifier.register_face(phone, image_binary)
+    try:
+        success = get_biometric_verifier().register_face(phone, image_binary)
+    except PoolTimeout:
+        return jsonify({"success": False, "message": "Face service is busy, please retry"}), 503
     
     if success:
-        # Emit event for real-time updates
-        socketio.emit('trust_id_update', {'phone': phone, 'has_face': True})
-        return jsonify({"success": True})
+        # Emit event for real-time updates; model readiness follows once trained
+        template = get_biometric_verifier().get_template(phone)
+        model_status = template['metadata'].get('model_status', 'unavailable') if template else 'unavailable'
+        socketio.emit('trust_id_update', {'phone': phone, 'has_face': True, 'model_status': model_status})
+        return jsonify({"success": True, "model_status": model_status})
     else:
         return jsonify({"success": False, "message": "Failed to detect face in image"})
 
+@app.route("/api/register-faces", methods=["POST"])
+def register_faces():
+    """Bulk enrollment from uploaded images named <phone>.jpg and/or a zip archive of them"""
+    items = [(f.filename, os.path.splitext(os.path.basename(f.filename))[0], f.read())
+             for f in request.files.getlist("images") if f.filename]
+    archive = request.files.get("archive")
+    if archive:
+        try:
+            items.extend(enrollment_items_from_zip(archive.stream))
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({"success": False, "message": f"Invalid archive: {str(e)}"}), 400
+
+    if not items:
+        return jsonify({"success": False, "message": "Upload images or a zip archive of images named <phone>.jpg"}), 400
+    if len(items) > BULK_ENROLL_MAX_IMAGES:
+        return jsonify({"success": False, "message": f"At most {BULK_ENROLL_MAX_IMAGES} images per request"}), 400
+
+    try:
+        report = get_biometric_verifier().register_faces(items)
+    except PoolTimeout:
+        return jsonify({"success": False, "message": "Face service is busy, please retry"}), 503
+
+    enrolled = [entry for entry in report if entry["success"]]
+    for entry in enrolled:
+        socketio.emit('trust_id_update', {
+            'phone': entry["phone"], 'has_face': True, 'model_status': entry["model_status"]
+        })
+
+    return jsonify({
+        "success": True,
+        "enrolled": len(enrolled),
+        "failed": len(report) - len(enrolled),
+        "results": report
+    })
+
+def on_face_model_trained(phone, model_status):
+    """Tell connected clients that a face enrollment finished training"""
+    socketio.emit('trust_id_update', {'phone': phone, 'has_face': True, 'model_status': model_status})
+
+add_training_listener(on_face_model_trained)
+
 @app.route("/api/check-biometrics", methods=["GET"])
 def check_biometrics():
     # Import to check if face_recognition is available
@@ -698,34 +966,21 @@ def check_biometrics():
         "mode": "face_recognition" if FACE_RECOGNITION_AVAILABLE else "hash_based"
     })
 
+@app.route("/api/biometrics/metrics")
+def biometrics_metrics():
+    return jsonify(get_biometric_verifier().stats())
+
 @app.route("/api/verify-face", methods=["POST"])
 def verify_face():
-    data = request.json
-    if not data or "phone" not in data or "image_data" not in data:
+    data, image_binary = read_face_upload()
+    if "phone" not in data or not image_binary:
         return jsonify({"success": False, "message": "Phone and image data are required"}), 400
     
     phone = data["phone"]
-    image_data = data["image_data"]
-    
-    # Remove data URL prefix
-    if image_data.startswith('data:image'):
-        image_data = image_data.split(',')[1]
-    
-    # Convert base64 to binary
-    import base64
-    image_binary = base64.b64decode(image_data)
-    
-    # Import BiometricVerifier
-    from utils.biometrics import BiometricVerifier
-    
-    # Check if BiometricVerifier exists
-    if not hasattr(app, 'biometric_verifier'):
-        app.biometric_verifier = BiometricVerifier()
-        return jsonify({"verified": False, "message": "No face registered for this phone"})
     
     # Verify face
     try:
-        verification_result = app.biometric_verifier.verify_face(phone, image_binary)
+        verification_result = get_biometric_verifier().verify_face(phone, image_binary)
         # Explicitly cast to Python native bool to ensure it's serializable
         verified = True if verification_result else False
         
@@ -740,6 +995,12 @@ def verify_face():
             "verified": verified,
             "success": True
         })
+    except PoolTimeout:
+        return jsonify({
+            "verified": False,
+            "success": False,
+            "message": "Face service is busy, please retry"
+        }), 503
     except Exception as e:
         app.logger.error(f"Face verification error: {str(e)}")
         return jsonify({
@@ -748,6 +1009,42 @@ def verify_face():
             "message": f"An error occurred during verification: {str(e)}"
         }), 500
 
+@app.route("/api/identify-face", methods=["POST"])
+def identify_face():
+    # Identifying a face discloses registered phone numbers, so only TTs may ask
+    if "tt_id" not in session:
+        return jsonify({"success": False, "message": "Not authenticated as TT"}), 401
+    
+    data, image_binary = read_face_upload()
+    if not image_binary:
+        return jsonify({"success": False, "message": "Image data is required"}), 400
+
+    try:
+        top_k = int(data.get("top_k", 5))
+    except (TypeError, ValueError):
+        top_k = None
+    if top_k is None or not 1 <= top_k <= 50:
+        return jsonify({"success": False, "message": "top_k must be an integer from 1 to 50"}), 400
+
+    # Rank every registered face against the image
+    try:
+        candidates = get_biometric_verifier().identify_face(image_binary, top_k=top_k)
+        # Only matching registrations are disclosed, never the nearest strangers
+        matches = [candidate for candidate in candidates if candidate['matched']]
+        return jsonify({
+            "success": True,
+            "matched": bool(matches),
+            "candidates": matches
+        })
+    except PoolTimeout:
+        return jsonify({"success": False, "message": "Face service is busy, please retry"}), 503
+    except Exception as e:
+        app.logger.error(f"Face identification error: {str(e)}")
+        return jsonify({
+            "success": False,
+            "message": f"An error occurred during identification: {str(e)}"
+        }), 500
+
 # TT Login and Dashboard Routes
 @app.route("/tt_login", methods=["GET", "POST"])
 def tt_login():
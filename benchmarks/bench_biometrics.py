@@ -0,0 +1,349 @@
+"""Face verification benchmarks and accuracy harness
+
+Builds galleries of increasing size in a temporary directory and measures
+enrollment time, 1:1 and 1:N verification latency and memory use, together
+with the false accept and false reject rates of every matching method in
+BiometricVerifier at the current thresholds. The equal error rate threshold
+of each method is reported as well, to guide threshold changes.
+
+Synthetic galleries are procedurally drawn 200x200 face crops, matched
+directly without face detection. A directory of real photos named
+<person>_<n>.jpg can be used instead with --images; the first photo of each
+person is enrolled and the rest are used as probes through the full
+decode and detection pipeline. Results are printed as JSON so runs can be
+compared across commits.
+
+Usage:
+    python benchmarks/bench_biometrics.py --sizes 100 1000 --output bench.json
+    python benchmarks/bench_biometrics.py --images ./lfw_subset --output bench.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.biometrics import (LBPH_THRESHOLD, SSIM_THRESHOLD, BiometricVerifier,  # noqa: E402
+                              enrollment_items_from_dir)
+from utils.face_recognizer import augment_face  # noqa: E402
+
+# The MSE threshold used before MSE was replaced by SSIM as the similarity decision
+MSE_THRESHOLD = 4000
+
+# Decision rule per method: (score key, accepts(score, threshold), threshold)
+METHODS = {
+    'lbph': ('lbph_confidence', lambda score, threshold: score < threshold, LBPH_THRESHOLD),
+    'ssim': ('ssim', lambda score, threshold: score > threshold, SSIM_THRESHOLD),
+    'mse': ('mse', lambda score, threshold: score < threshold, MSE_THRESHOLD)
+}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Summarize latencies in seconds as ops/sec and p50/p99 in milliseconds"""
+    total = sum(samples)
+    return {
+        'runs': len(samples),
+        'ops_per_second': round(len(samples) / total, 2) if total else None,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3)
+    }
+
+
+def memory_mb():
+    """Current and peak resident set size of this process in MiB"""
+    with open('/proc/self/statm') as f:
+        current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'rss_mb': round(current / 2 ** 20, 1), 'peak_rss_mb': round(peak / 2 ** 20, 1)}
+
+
+def synthetic_identity(rng):
+    """Random facial geometry and skin texture of one synthetic person"""
+    return {
+        'skin': rng.uniform(110, 200),
+        'face_axes': (rng.uniform(55, 75), rng.uniform(70, 90)),
+        'eye_y': rng.uniform(75, 95),
+        'eye_dx': rng.uniform(20, 35),
+        'eye_r': rng.uniform(6, 12),
+        'nose_len': rng.uniform(15, 30),
+        'mouth_y': rng.uniform(135, 155),
+        'mouth_w': rng.uniform(15, 30),
+        'texture_seed': rng.getrandbits(32)
+    }
+
+
+def draw_face(identity):
+    """Draw a 200x200 grayscale face crop for a synthetic identity"""
+    face = np.full((200, 200), 60, dtype=np.uint8)
+    cv2.ellipse(face, (100, 105), tuple(int(a) for a in identity['face_axes']), 0, 0, 360,
+                int(identity['skin']), -1)
+
+    # Low-frequency texture unique to the identity
+    texture = np.random.RandomState(identity['texture_seed']).normal(0, 18, (20, 20)).astype(np.float32)
+    face = np.clip(face + cv2.resize(texture, (200, 200), interpolation=cv2.INTER_CUBIC), 0, 255).astype(np.uint8)
+
+    eye_y, eye_dx, eye_r = int(identity['eye_y']), int(identity['eye_dx']), int(identity['eye_r'])
+    for x in (100 - eye_dx, 100 + eye_dx):
+        cv2.circle(face, (x, eye_y), eye_r, 40, -1)
+        cv2.circle(face, (x, eye_y), max(2, eye_r // 3), 10, -1)
+    cv2.line(face, (100, eye_y + 10), (100, eye_y + 10 + int(identity['nose_len'])), 70, 3)
+    cv2.ellipse(face, (100, int(identity['mouth_y'])), (int(identity['mouth_w']), 6), 0, 0, 180, 50, 3)
+    return face
+
+
+def capture(face, rng):
+    """Simulate a new camera capture of a face: pose, lighting and sensor noise"""
+    angle = rng.uniform(-8, 8)
+    matrix = cv2.getRotationMatrix2D((100, 100), angle, rng.uniform(0.95, 1.05))
+    matrix[:, 2] += (rng.uniform(-5, 5), rng.uniform(-5, 5))
+    moved = cv2.warpAffine(face, matrix, (200, 200), borderMode=cv2.BORDER_REPLICATE)
+    lit = moved.astype(np.float32) * rng.uniform(0.85, 1.15) + rng.uniform(-15, 15)
+    noisy = lit + np.random.RandomState(rng.getrandbits(32)).normal(0, 6, lit.shape)
+    return np.clip(noisy, 0, 255).astype(np.uint8)
+
+
+def crop_probe(face):
+    """Build a verification probe from a face crop, as prepare_probe would"""
+    return {
+        'image_hash': hashlib.sha256(face.tobytes()).hexdigest(),
+        'face_gray': cv2.equalizeHist(face),
+        'face_compare': face
+    }
+
+
+def enroll_synthetic(verifier, faces):
+    """Register synthetic face crops with the verifier's stores in one batch"""
+    encoded = {phone: cv2.imencode('.jpg', face)[1].tobytes() for phone, face in faces.items()}
+    verifier.gallery.add_many(faces)
+    if verifier.advanced_recognition:
+        verifier.recognizer.enroll_many({phone: augment_face(cv2.equalizeHist(face)) for phone, face in faces.items()})
+    verifier.store.put_many([(phone, {
+        'phone': phone,
+        'face_hash': hashlib.sha256(encoded[phone]).hexdigest(),
+        'timestamp': datetime.now().isoformat(),
+        'method': 'opencv_enhanced',
+        'has_model': verifier.advanced_recognition,
+        'model_status': 'ready' if verifier.advanced_recognition else 'unavailable'
+    }, {'face': encoded[phone], 'face_gray': encoded[phone]}) for phone in faces])
+
+
+def error_rates(genuine, impostor):
+    """False accept and reject rates of every method at its current threshold"""
+    report = {}
+    for method, (key, accepts, threshold) in METHODS.items():
+        genuine_scores = [scores[key] for scores in genuine if key in scores]
+        impostor_scores = [scores[key] for scores in impostor if key in scores]
+        if not genuine_scores or not impostor_scores:
+            continue
+
+        def rates(t):
+            far = sum(accepts(score, t) for score in impostor_scores) / len(impostor_scores)
+            frr = sum(not accepts(score, t) for score in genuine_scores) / len(genuine_scores)
+            return far, frr
+
+        far, frr = rates(threshold)
+
+        # Equal error rate over every observed score as a candidate threshold
+        eer_threshold = min(sorted(set(genuine_scores + impostor_scores)),
+                            key=lambda t: abs(rates(t)[0] - rates(t)[1]))
+        eer_far, eer_frr = rates(eer_threshold)
+
+        report[method] = {
+            'threshold': threshold,
+            'far': round(far, 4),
+            'frr': round(frr, 4),
+            'eer': round((eer_far + eer_frr) / 2, 4),
+            'eer_threshold': round(eer_threshold, 4)
+        }
+
+    # The verifier's own decision, where any method may accept
+    report['verifier'] = {
+        'far': round(sum(scores['matched'] for scores in impostor) / len(impostor), 4),
+        'frr': round(sum(not scores['matched'] for scores in genuine) / len(genuine), 4)
+    }
+    return report
+
+
+def verify_pairs(verifier, pairs):
+    """Score (claimed phone, probe, genuine) pairs and time 1:1 verification"""
+    genuine, impostor, latencies = [], [], []
+    for phone, probe, is_genuine in pairs:
+        template = verifier.get_template(phone)
+        started = time.perf_counter()
+        verifier.verify_against_specific_user(phone, b'', probe=probe)
+        latencies.append(time.perf_counter() - started)
+
+        scores = verifier.score_template(probe, template, exhaustive=True)
+        (genuine if is_genuine else impostor).append(scores)
+    return genuine, impostor, latencies
+
+
+def identify_probes(verifier, probes):
+    """Time 1:N identification and measure rank-1 accuracy"""
+    latencies, correct = [], 0
+    for phone, probe in probes:
+        started = time.perf_counter()
+        candidates = verifier.identify_face(b'', top_k=1, probe=probe)
+        latencies.append(time.perf_counter() - started)
+        correct += bool(candidates) and candidates[0]['phone'] == phone
+    return latencies, correct / len(probes) if probes else None
+
+
+def bench_synthetic(size, args):
+    """Run every benchmark against a synthetic gallery of the given size"""
+    faces_dir = tempfile.mkdtemp(prefix=f"railguard-bench-faces-{size}-")
+    try:
+        rng = random.Random(size)
+        verifier = BiometricVerifier(faces_dir)
+        identities = {str(7000000000 + i): synthetic_identity(rng) for i in range(size)}
+        faces = {phone: draw_face(identity) for phone, identity in identities.items()}
+
+        started = time.perf_counter()
+        enroll_synthetic(verifier, faces)
+        enroll_seconds = time.perf_counter() - started
+        results = {
+            'faces': size,
+            'enroll': {'seconds': round(enroll_seconds, 3),
+                       'per_face_ms': round(enroll_seconds / size * 1000, 3)},
+            'memory_after_enroll': memory_mb()
+        }
+
+        # Genuine captures of sampled users, each also claimed as somebody else
+        phones = list(identities)
+        sampled = rng.sample(phones, min(size, args.probes))
+        pairs, probes = [], []
+        for phone in sampled:
+            probe = crop_probe(capture(faces[phone], rng))
+            other = rng.choice([p for p in sampled if p != phone] or phones)
+            pairs.append((phone, probe, True))
+            pairs.append((other, probe, other == phone))
+            probes.append((phone, probe))
+
+        genuine, impostor, latencies = verify_pairs(verifier, pairs)
+        results['verify_1_1'] = summarize(latencies)
+
+        id_latencies, rank1 = identify_probes(verifier, probes[:args.identify_probes])
+        results['identify_1_n'] = summarize(id_latencies)
+        results['identify_1_n']['rank1_accuracy'] = round(rank1, 4)
+
+        results['accuracy'] = error_rates(genuine, impostor)
+        results['accuracy']['pairs'] = {'genuine': len(genuine), 'impostor': len(impostor)}
+        results['storage'] = {'store': verifier.store.stats(), 'gallery_bytes': os.path.getsize(verifier.gallery.crops_path)}
+        results['memory'] = memory_mb()
+        return results
+    finally:
+        shutil.rmtree(faces_dir, ignore_errors=True)
+
+
+def bench_images(image_dir, args):
+    """Run the benchmarks through the full pipeline on photos named <person>_<n>.jpg"""
+    faces_dir = tempfile.mkdtemp(prefix="railguard-bench-faces-real-")
+    try:
+        by_person = defaultdict(list)
+        for source, name, image_binary in enrollment_items_from_dir(image_dir):
+            person = name.rsplit('_', 1)[0]
+            by_person[person].append(image_binary)
+
+        # Phone numbers stand in for person names
+        people = sorted(p for p, images in by_person.items() if len(images) >= 2)
+        phones = {person: str(7000000000 + i) for i, person in enumerate(people)}
+        verifier = BiometricVerifier(faces_dir)
+
+        started = time.perf_counter()
+        report = verifier.register_faces([(person, phones[person], by_person[person][0]) for person in people],
+                                         workers=args.workers)
+        enroll_seconds = time.perf_counter() - started
+        enrolled = {entry['source'] for entry in report if entry['success']}
+        results = {
+            'faces': len(enrolled),
+            'enroll': {'seconds': round(enroll_seconds, 3),
+                       'per_face_ms': round(enroll_seconds / max(1, len(people)) * 1000, 3),
+                       'failed': len(people) - len(enrolled)},
+            'memory_after_enroll': memory_mb()
+        }
+
+        rng = random.Random(len(people))
+        probe_latencies, pairs, probes = [], [], []
+        for person in [p for p in people if p in enrolled][:args.probes]:
+            for image_binary in by_person[person][1:]:
+                started = time.perf_counter()
+                probe = verifier.prepare_probe(image_binary)
+                probe_latencies.append(time.perf_counter() - started)
+                if probe is None or probe['face_gray'] is None:
+                    continue
+                other = rng.choice([p for p in enrolled if p != person] or [person])
+                pairs.append((phones[person], probe, True))
+                pairs.append((phones[other], probe, other == person))
+                probes.append((phones[person], probe))
+
+        results['decode_detect'] = summarize(probe_latencies) if probe_latencies else None
+        if pairs:
+            genuine, impostor, latencies = verify_pairs(verifier, pairs)
+            results['verify_1_1'] = summarize(latencies)
+            id_latencies, rank1 = identify_probes(verifier, probes[:args.identify_probes])
+            results['identify_1_n'] = summarize(id_latencies)
+            results['identify_1_n']['rank1_accuracy'] = round(rank1, 4)
+            results['accuracy'] = error_rates(genuine, impostor)
+            results['accuracy']['pairs'] = {'genuine': len(genuine), 'impostor': len(impostor)}
+        results['memory'] = memory_mb()
+        return results
+    finally:
+        shutil.rmtree(faces_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark face verification speed and accuracy")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000],
+                        help="Synthetic gallery sizes to benchmark")
+    parser.add_argument("--images", help="Directory of real photos named <person>_<n>.jpg instead of synthetic faces")
+    parser.add_argument("--probes", type=int, default=200, help="Users probed per gallery")
+    parser.add_argument("--identify-probes", type=int, default=50, help="1:N identifications per gallery")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for enrolling real photos")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    if args.images:
+        results = [bench_images(args.images, args)]
+    else:
+        results = [bench_synthetic(size, args) for size in args.sizes]
+
+    report = {
+        'benchmark': 'biometrics',
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'gallery': 'images' if args.images else 'synthetic',
+        'results': results
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Trust ID blockchain benchmarks
+
+Builds synthetic chains of increasing length in a temporary directory and
+measures how Trust ID creation, lookup, chain verification and ledger
+loading scale with chain length. Results are printed as JSON so runs can
+be compared across commits.
+
+Usage:
+    python benchmarks/bench_blockchain.py --sizes 1000 10000 100000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils.blockchain as blockchain_module  # noqa: E402
+from utils.blockchain import (BlockchainVerifier, TransactionPool, audit_chain_parallel,  # noqa: E402
+                              compute_tid_hash, create_trust_id, hash_block, verify_trust_id)
+from utils.mining import BLOCKCHAIN_DIFFICULTY  # noqa: E402
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Summarize latencies in seconds as ops/sec and p50/p99 in milliseconds"""
+    total = sum(samples)
+    return {
+        'runs': len(samples),
+        'ops_per_second': round(len(samples) / total, 2) if total else None,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3)
+    }
+
+
+def timed(func, *args):
+    """Run func once and return (result, seconds)"""
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def build_chain(blockchain_dir, size, seed=42):
+    """Write a valid synthetic ledger of the given length
+
+    Blocks carry single Trust ID transactions like the original chain and
+    skip proof of work, which the verifier does not re-check.
+
+    Returns:
+        list: Trust ID hashes stored in the chain
+    """
+    rng = random.Random(seed)
+    tid_hashes = []
+    previous_hash = '0' * 64
+
+    with open(os.path.join(blockchain_dir, 'ledger.jsonl'), 'w') as f:
+        for index in range(size):
+            if index == 0:
+                data = 'Genesis Block - RailGuard India Trust ID System'
+            else:
+                data = {
+                    'phone': str(6000000000 + index),
+                    'aadhaar_hash': '',
+                    'timestamp': 1745116853 + index,
+                    'salt': '%016x' % rng.getrandbits(64)
+                }
+                tid_hashes.append(compute_tid_hash(data['phone'], data['timestamp'], data['salt']))
+
+            block = {
+                'index': index,
+                'timestamp': datetime(2025, 4, 20).isoformat(),
+                'data': data,
+                'previous_hash': previous_hash,
+                'nonce': 0
+            }
+            block['hash'] = previous_hash = hash_block(block)
+            f.write(json.dumps(block, separators=(',', ':')) + '\n')
+
+    return tid_hashes
+
+
+def use_blockchain(blockchain):
+    """Make the module-level helpers operate on the given chain"""
+    blockchain_module._shared_blockchain = blockchain
+    blockchain_module._shared_pool = TransactionPool(blockchain, max_size=1, max_wait=0)
+
+
+def bench_size(size, args):
+    """Run every benchmark against a chain of the given length"""
+    blockchain_dir = tempfile.mkdtemp(prefix=f"railguard-bench-{size}-")
+    try:
+        tid_hashes, build_seconds = timed(build_chain, blockchain_dir, size)
+        results = {'blocks': size, 'build_seconds': round(build_seconds, 3)}
+
+        # Cold load builds the Trust ID index, warm load reads it back
+        blockchain, cold = timed(BlockchainVerifier, blockchain_dir)
+        _, warm = timed(BlockchainVerifier, blockchain_dir)
+        results['load'] = {'cold_seconds': round(cold, 3), 'warm_seconds': round(warm, 3)}
+
+        # Full verification re-hashes every block from genesis
+        results['verify_chain_full'] = summarize(
+            [timed(blockchain.verify_chain, True)[1] for _ in range(args.verify_repeats)])
+        results['verify_chain_incremental'] = summarize(
+            [timed(blockchain.verify_chain)[1] for _ in range(args.lookups)])
+        results['audit_parallel'] = {
+            key: value for key, value in audit_chain_parallel(
+                blockchain_dir, workers=args.workers, progress=lambda *_: None).items()
+            if key in ('workers', 'elapsed_seconds', 'blocks_per_second')
+        }
+
+        use_blockchain(blockchain)
+
+        # Half known and half unknown hashes
+        rng = random.Random(size)
+        probes = [rng.choice(tid_hashes) if i % 2 else '%064x' % rng.getrandbits(256)
+                  for i in range(args.lookups)]
+        results['verify_trust_id'] = summarize([timed(verify_trust_id, tid_hash)[1] for tid_hash in probes])
+
+        results['create_trust_id'] = summarize(
+            [timed(create_trust_id, str(9000000000 + i))[1] for i in range(args.creates)])
+
+        blockchain.miner.shutdown()
+        return results
+    finally:
+        shutil.rmtree(blockchain_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Trust ID operations against chain length")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Chain lengths to benchmark")
+    parser.add_argument("--creates", type=int, default=100, help="create_trust_id calls per size")
+    parser.add_argument("--lookups", type=int, default=2000, help="verify_trust_id calls per size")
+    parser.add_argument("--verify-repeats", type=int, default=3, help="Full verify_chain runs per size")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for the parallel audit")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = {
+        'benchmark': 'blockchain',
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'difficulty': BLOCKCHAIN_DIFFICULTY,
+        'results': [bench_size(size, args) for size in args.sizes]
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,245 @@
 import os
+import json
 import logging
+import threading
+import time
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_extraction.text import CountVectorizer
-import pickle
+from datetime import datetime
+import joblib
 import re
 
+from utils.micro_batcher import MicroBatcher
+
 logger = logging.getLogger(__name__)
 
-# Initialize and train a simple model
-# In production, this would be a properly trained model
-def initialize_model():
-    """Initialize a simple AI model for complaint analysis"""
-    # Mock training data
-    complaints = [
-        "TT asked for money without giving receipt",
-        "I was fined without any reason",
-        "TT demanded cash and refused to give receipt",
-        "TT threatened me for not having proper ticket",
-        "Train was late by 2 hours",
-        "AC was not working in my coach",
-        "Food quality was poor",
-        "Toilet was dirty",
-        "My seat was occupied by someone else",
-        "TT forced me to pay extra",
-        "TT charged me extra for luggage without measuring",
-        "TT issued fine without checking my ticket properly",
-        "No water in toilet",
-        "Train was overcrowded",
-        "Standing passengers not allowed in reserved coach"
-    ]
-    
-    # Labels (high risk = 1, low risk = 0)
-    labels = [1, 1, 1, 1, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0]
-    
+# Directory holding exported complaint model versions and the active version pointer
+COMPLAINT_MODEL_DIR = os.environ.get(
+    "COMPLAINT_MODEL_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ai_models'))
+
+# Bumped whenever the layout of the saved artifact changes
+COMPLAINT_MODEL_FORMAT = 1
+
+# Most texts accepted by one scoring request
+COMPLAINT_SCORE_MAX_TEXTS = int(os.environ.get("COMPLAINT_SCORE_MAX_TEXTS", "1000"))
+
+# Concurrent single complaints are scored together: largest batch, and how long
+# the first complaint of a batch may wait for others to join it
+COMPLAINT_BATCH_MAX_SIZE = int(os.environ.get("COMPLAINT_BATCH_MAX_SIZE", "64"))
+COMPLAINT_BATCH_MAX_WAIT_MS = float(os.environ.get("COMPLAINT_BATCH_MAX_WAIT_MS", "2"))
+COMPLAINT_BATCH_TIMEOUT = float(os.environ.get("COMPLAINT_BATCH_TIMEOUT", "5.0"))
+
+# Mock training data (high risk = 1, low risk = 0)
+# In production, this would be a properly labelled complaint history
+TRAINING_COMPLAINTS = [
+    ("TT asked for money without giving receipt", 1),
+    ("I was fined without any reason", 1),
+    ("TT demanded cash and refused to give receipt", 1),
+    ("TT threatened me for not having proper ticket", 1),
+    ("Train was late by 2 hours", 0),
+    ("AC was not working in my coach", 0),
+    ("Food quality was poor", 0),
+    ("Toilet was dirty", 0),
+    ("My seat was occupied by someone else", 0),
+    ("TT forced me to pay extra", 1),
+    ("TT charged me extra for luggage without measuring", 1),
+    ("TT issued fine without checking my ticket properly", 1),
+    ("No water in toilet", 0),
+    ("Train was overcrowded", 0),
+    ("Standing passengers not allowed in reserved coach", 0)
+]
+
+
+def train_model(samples=None):
+    """Fit the complaint vectorizer and classifier
+
+    Args:
+        samples: (text, label) pairs, defaults to TRAINING_COMPLAINTS
+
+    Returns:
+        tuple: (vectorizer, model)
+    """
+    # scikit-learn is only imported by workers that actually score complaints
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    samples = samples or TRAINING_COMPLAINTS
+    complaints = [text for text, _ in samples]
+    labels = [int(label) for _, label in samples]
+
     # Create a bag of words model
     vectorizer = CountVectorizer()
     X = vectorizer.fit_transform(complaints)
-    
+
     # Train a Random Forest model
     model = RandomForestClassifier(n_estimators=10, random_state=42)
     model.fit(X, labels)
-    
+
     return vectorizer, model
 
-# Initialize the model and vectorizer
-vectorizer, complaint_model = initialize_model()
+
+def _pointer_path(model_dir):
+    return os.path.join(model_dir, "current.json")
+
+
+def list_model_versions(model_dir=None):
+    """List exported model versions, oldest first"""
+    model_dir = model_dir or COMPLAINT_MODEL_DIR
+    versions = []
+    if os.path.isdir(model_dir):
+        for name in os.listdir(model_dir):
+            match = re.fullmatch(r"complaint_model_v(\d+)\.joblib", name)
+            if match:
+                versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def export_model(vectorizer, model, model_dir=None, samples=0, activate=True):
+    """Save a trained model as the next version and optionally make it current
+
+    The current.json pointer is replaced last, so workers never see a
+    partially written version.
+
+    Returns:
+        dict: Metadata of the exported version
+    """
+    import sklearn
+
+    model_dir = model_dir or COMPLAINT_MODEL_DIR
+    os.makedirs(model_dir, exist_ok=True)
+
+    versions = list_model_versions(model_dir)
+    version = versions[-1] + 1 if versions else 1
+    filename = f"complaint_model_v{version:04d}.joblib"
+    info = {
+        'format': COMPLAINT_MODEL_FORMAT,
+        'version': version,
+        'file': filename,
+        'created_at': datetime.now().isoformat(),
+        'sklearn_version': sklearn.__version__,
+        'samples': samples
+    }
+
+    path = os.path.join(model_dir, filename)
+    joblib.dump({'info': info, 'vectorizer': vectorizer, 'model': model}, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+    if activate:
+        activate_model_version(version, model_dir)
+    logger.info(f"Exported complaint model version {version} to {path}")
+    return info
+
+
+def activate_model_version(version, model_dir=None):
+    """Point workers at an exported model version"""
+    model_dir = model_dir or COMPLAINT_MODEL_DIR
+    filename = f"complaint_model_v{int(version):04d}.joblib"
+    if not os.path.exists(os.path.join(model_dir, filename)):
+        raise FileNotFoundError(f"Complaint model version {version} not found in {model_dir}")
+
+    pointer_path = _pointer_path(model_dir)
+    with open(f"{pointer_path}.tmp", 'w') as f:
+        json.dump({'version': int(version), 'file': filename}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{pointer_path}.tmp", pointer_path)
+
+
+def load_model(model_dir=None):
+    """Load the current exported model version
+
+    Returns:
+        tuple: (vectorizer, model, info)
+
+    Raises:
+        FileNotFoundError: No version has been exported
+        ValueError: The artifact was written in an unsupported format
+    """
+    import sklearn
+
+    model_dir = model_dir or COMPLAINT_MODEL_DIR
+    with open(_pointer_path(model_dir), 'r') as f:
+        pointer = json.load(f)
+
+    # Every worker loads its own copy: unpickling a tree copies its node
+    # arrays, so memory-mapping the artifact would not share them
+    artifact = joblib.load(os.path.join(model_dir, pointer['file']))
+    info = artifact.get('info', {})
+    if info.get('format') != COMPLAINT_MODEL_FORMAT:
+        raise ValueError(f"Unsupported complaint model format {info.get('format')} in {pointer['file']}")
+    if info.get('sklearn_version') != sklearn.__version__:
+        logger.warning(f"Complaint model version {info['version']} was trained with scikit-learn "
+                       f"{info.get('sklearn_version')}, running {sklearn.__version__}")
+    return artifact['vectorizer'], artifact['model'], info
+
+
+class ComplaintModel:
+    """Complaint classifier loaded lazily on first use
+
+    The exported version named by current.json is loaded the first time a
+    complaint is scored, and again whenever the pointer changes. Without an
+    exported version the built-in training data is fitted in memory instead.
+    """
+
+    def __init__(self, model_dir=None):
+        self.model_dir = model_dir or COMPLAINT_MODEL_DIR
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._pointer_mtime_ns = None
+        self.info = None
+
+    def get(self):
+        """Return (vectorizer, model), loading the current version if needed"""
+        try:
+            mtime_ns = os.stat(_pointer_path(self.model_dir)).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+
+        if self._loaded is not None and mtime_ns == self._pointer_mtime_ns:
+            return self._loaded
+
+        with self._lock:
+            if self._loaded is not None and mtime_ns == self._pointer_mtime_ns:
+                return self._loaded
+
+            started = time.perf_counter()
+            loaded = None
+            if mtime_ns is not None:
+                try:
+                    vectorizer, model, info = load_model(self.model_dir)
+                    loaded = (vectorizer, model)
+                except Exception as e:
+                    logger.error(f"Failed to load complaint model from {self.model_dir}: {str(e)}")
+
+            if loaded is None:
+                if self._loaded is not None:
+                    # Keep serving the version already in memory
+                    self._pointer_mtime_ns = mtime_ns
+                    return self._loaded
+                logger.warning(f"No exported complaint model in {self.model_dir}, "
+                               f"training on built-in data (run: python -m utils.ai train)")
+                loaded = train_model()
+                info = {'version': None, 'samples': len(TRAINING_COMPLAINTS)}
+
+            self._loaded = loaded
+            self.info = info
+            self._pointer_mtime_ns = mtime_ns
+            logger.info(f"Complaint model version {info['version']} ready in "
+                        f"{(time.perf_counter() - started) * 1000:.1f} ms")
+            return self._loaded
+
+
+_complaint_model = ComplaintModel()
+
+
+def get_complaint_model():
+    """Return the process-wide (vectorizer, model) pair"""
+    return _complaint_model.get()
+
+# Words that mark a complaint high risk wherever they appear in the text
+HIGH_RISK_KEYWORDS = ['money', 'cash', 'bribe', 'receipt', 'fine', 'illegal', 'extra', 'demanded', 'threatened']
+
+# One pass over the text finds any keyword, including inside longer words ("fined", "extras")
+HIGH_RISK_PATTERN = re.compile("|".join(re.escape(keyword) for keyword in HIGH_RISK_KEYWORDS))
 
 def analyze_complaint_risk(complaint_text):
     """
@@ -58,32 +252,75 @@ def analyze_complaint_risk(complaint_text):
         str: Risk level ('High' or 'Low')
     """
     try:
-        # Check for key risk words
-        high_risk_keywords = ['money', 'cash', 'bribe', 'receipt', 'fine', 'illegal', 'extra', 'demanded', 'threatened']
-        
-        # Preprocess text
-        complaint_text = complaint_text.lower()
-        
-        # Direct keyword matching for high-risk terms
-        for keyword in high_risk_keywords:
-            if keyword in complaint_text:
-                logger.info(f"High risk keyword '{keyword}' found in complaint")
-                return "High"
-        
-        # Use the model for more nuanced prediction
-        X = vectorizer.transform([complaint_text])
-        prediction = complaint_model.predict(X)[0]
-        
-        risk_level = "High" if prediction == 1 else "Low"
-        logger.info(f"AI model predicted risk level: {risk_level}")
-        
-        return risk_level
-    
+        return analyze_complaint_risk_batch([complaint_text])[0]
     except Exception as e:
         logger.error(f"Error analyzing complaint risk: {str(e)}")
         # Default to low risk in case of error
         return "Low"
 
+def analyze_complaint_risk_batch(complaint_texts):
+    """
+    Analyze many complaint texts at once
+    
+    Texts containing a high-risk keyword are High straight away; every other
+    text is classified by the model in a single sparse matrix transform and
+    predict call.
+    
+    Args:
+        complaint_texts (list): Complaint messages
+        
+    Returns:
+        list: Risk level ('High' or 'Low') for each text, in order
+
+    Raises:
+        Exception: The model could not be loaded or failed to predict
+    """
+    risk_levels = ["Low"] * len(complaint_texts)
+    model_texts, model_indexes = [], []
+    keyword_hits = 0
+
+    # Direct keyword matching for high-risk terms
+    for i, complaint_text in enumerate(complaint_texts):
+        complaint_text = (complaint_text or "").lower()
+        if HIGH_RISK_PATTERN.search(complaint_text):
+            risk_levels[i] = "High"
+            keyword_hits += 1
+        else:
+            model_texts.append(complaint_text)
+            model_indexes.append(i)
+
+    # Use the model for more nuanced prediction
+    if model_texts:
+        vectorizer, complaint_model = get_complaint_model()
+        predictions = complaint_model.predict(vectorizer.transform(model_texts))
+        for i, prediction in zip(model_indexes, predictions):
+            risk_levels[i] = "High" if prediction == 1 else "Low"
+
+    logger.info(f"Scored {len(complaint_texts)} complaints: {keyword_hits} high risk by keyword, "
+                f"{len(model_texts)} by the model")
+
+    return risk_levels
+
+complaint_batcher = MicroBatcher('complaint scoring', analyze_complaint_risk_batch,
+                                 max_batch_size=COMPLAINT_BATCH_MAX_SIZE,
+                                 max_wait_ms=COMPLAINT_BATCH_MAX_WAIT_MS)
+
+def score_complaint_risk(complaint_text):
+    """
+    Analyze one complaint as part of a batch with concurrent requests
+    
+    Args:
+        complaint_text (str): Complaint message
+        
+    Returns:
+        str: Risk level ('High' or 'Low')
+    """
+    try:
+        return complaint_batcher.submit(complaint_text).result(timeout=COMPLAINT_BATCH_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Batched complaint scoring failed, scoring directly: {str(e)}")
+        return analyze_complaint_risk(complaint_text)
+
 def predict_seat_reallocation(coach, vacant_seats):
     """
     Predict if seat reallocation is needed
@@ -135,3 +372,35 @@ def analyze_fraud_patterns(complaints, fines):
         "potential_fraudsters": potential_fraudsters,
         "fraud_risk": fraud_risk
     }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="RailGuard complaint model tools")
+    parser.add_argument("--dir", help="Model directory (defaults to ai_models/ next to the app)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="Train and export a new model version")
+    train_parser.add_argument("--data", help="JSON lines file of {\"text\": ..., \"label\": 0 or 1} (defaults to built-in data)")
+    train_parser.add_argument("--no-activate", action="store_true", help="Export without making it the current version")
+    subparsers.add_parser("list", help="List exported model versions")
+    activate_parser = subparsers.add_parser("activate", help="Make an exported version current")
+    activate_parser.add_argument("version", type=int)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        samples = None
+        if args.data:
+            with open(args.data, 'r') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            samples = [(row['text'], row['label']) for row in rows]
+        vectorizer, model = train_model(samples)
+        info = export_model(vectorizer, model, args.dir, samples=len(samples or TRAINING_COMPLAINTS),
+                            activate=not args.no_activate)
+        print(json.dumps(info, indent=2))
+    elif args.command == "list":
+        print(json.dumps(list_model_versions(args.dir)))
+    elif args.command == "activate":
+        activate_model_version(args.version, args.dir)
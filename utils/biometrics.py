@@ -6,9 +6,22 @@ import os
 import numpy as np
 import traceback
 import time
+import threading
+import multiprocessing
+import sys
+import zipfile
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from io import BytesIO
-import glob
+
+from utils.face_gallery import FaceGallery
+from utils.face_recognizer import GalleryRecognizer, augment_face, lbph_available
+from utils.face_store import FaceStore, migrate_flat_layout
+from utils.file_lock import hold_lock
+from utils.resource_pool import PoolTimeout, ResourcePool
 
 # Try to import OpenCV first - this will be our primary method
 try:
@@ -30,9 +43,354 @@ except ImportError:
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Match thresholds for each comparison method
+LBPH_THRESHOLD = 100.0  # LBPH distance, lower is closer; raised from 80 for more lenient matching
+SSIM_THRESHOLD = 0.35   # Structural similarity, higher is closer; reduced from 0.45
+
+# Longest image side searched by the face detector, and time after which
+# no further detection pass is started
+FACE_DETECT_MAX_SIDE = int(os.environ.get("FACE_DETECT_MAX_SIDE", "640"))
+FACE_DETECT_BUDGET_MS = float(os.environ.get("FACE_DETECT_BUDGET_MS", "250"))
+
+# Bulk enrollment limits and the processes used to prepare the images
+BULK_ENROLL_MAX_IMAGES = int(os.environ.get("BULK_ENROLL_MAX_IMAGES", "5000"))
+BULK_ENROLL_MAX_BYTES = int(os.environ.get("BULK_ENROLL_MAX_BYTES", str(512 * 1024 * 1024)))
+BULK_ENROLL_WORKERS = int(os.environ.get("BULK_ENROLL_WORKERS", "0")) or os.cpu_count() or 1
+
+# Image types accepted from archives and directories
+ENROLL_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# Memory budget for decoded face templates kept in memory
+FACE_CACHE_MAX_BYTES = int(os.environ.get("FACE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Callbacks told when a background enrollment has finished
+_training_listeners = []
+
+def add_training_listener(callback):
+    """Call callback(phone, model_status) whenever a background enrollment finishes"""
+    _training_listeners.append(callback)
+
+class FaceTemplateCache:
+    """LRU cache of decoded face templates keyed by phone number
+
+    Each entry holds the registration metadata, so repeat verifications
+    need no disk access. Least recently used entries are evicted once the
+    estimated memory use exceeds max_bytes.
+
+    Other processes write the same face store, so each entry remembers the
+    store version it was last checked at. A hit at a newer version is
+    checked again with validate() and reloaded if it went stale.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = FACE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _estimate_size(template):
+        """Estimate the memory held by a template in bytes"""
+        return len(json.dumps(template['metadata']))
+
+    def get(self, phone, loader, version=None, validate=None):
+        """Return the cached template for phone, loading it on a miss
+
+        Templates that cannot be loaded are not cached.
+
+        Args:
+            phone: Phone number
+            loader: Called with phone to load a template
+            version: Store version, taken before this call
+            validate: Called with a cached template when version moved on;
+                returns False if the template is stale
+        """
+        with self._lock:
+            entry = self._entries.get(phone)
+
+        # Validated outside the lock, as it reads the store
+        if entry is not None and entry[2] != version:
+            if validate is not None and not validate(entry[0]):
+                self.invalidate(phone)
+                entry = None
+            else:
+                with self._lock:
+                    if self._entries.get(phone) is entry:
+                        self._entries[phone] = (entry[0], entry[1], version)
+
+        with self._lock:
+            if entry is not None:
+                if phone in self._entries:
+                    self._entries.move_to_end(phone)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        template = loader(phone)
+        if template is None:
+            return None
+
+        size = self._estimate_size(template)
+        with self._lock:
+            if phone in self._entries:
+                self.current_bytes -= self._entries.pop(phone)[1]
+            self._entries[phone] = (template, size, version)
+            self.current_bytes += size
+
+            # Evict least recently used templates beyond the budget
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+        return template
+
+    def invalidate(self, phone):
+        """Drop the cached template for phone"""
+        with self._lock:
+            entry = self._entries.pop(phone, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def stats(self):
+        """Return cache size and hit counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+def load_face_detectors():
+    """Load one set of Haar cascades for face detection"""
+    return {
+        # Try to load both frontal and profile face cascades for better detection
+        'frontal': cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'),
+        'profile': cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml'),
+        # Also load eye detection for improved verification
+        'eye': cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+    }
+
+def detect_faces(img_cv, detectors):
+    """Detect faces in a BGR or grayscale image with increased accuracy by trying multiple methods
+
+    Large frames are searched at a working resolution of at most
+    FACE_DETECT_MAX_SIDE pixels and the boxes are mapped back to the full
+    image. Passes run in order of reliability and the first one that
+    finds a face wins. No further pass is started once
+    FACE_DETECT_BUDGET_MS has been spent.
+
+    Returns:
+        tuple: (equalized full-resolution grayscale image, face boxes)
+    """
+    try:
+        started = time.perf_counter()
+
+        # Convert to grayscale for detection
+        gray = img_cv if img_cv.ndim == 2 else cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
+
+        # Equalize histogram to improve detection in different lighting
+        gray = cv2.equalizeHist(gray)
+
+        # Search a downsampled copy of large frames
+        scale = min(1.0, FACE_DETECT_MAX_SIDE / max(gray.shape[:2]))
+        if scale < 1.0:
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            small = gray
+
+        # Frontal faces first, then profile faces, then even more lenient parameters
+        passes = [
+            ('frontal', 1.2, 3, 30, small, scale),
+            ('profile', 1.2, 3, 30, small, scale),
+            ('frontal', 1.3, 2, 20, small, scale)
+        ]
+        if scale < 1.0:
+            # Faces too small for the working resolution are searched at full size last
+            passes.append(('frontal', 1.2, 3, 30, gray, 1.0))
+
+        for i, (cascade, scale_factor, min_neighbors, min_size, image, pass_scale) in enumerate(passes):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if i > 0 and elapsed_ms > FACE_DETECT_BUDGET_MS:
+                logger.warning(f"Face detection budget of {FACE_DETECT_BUDGET_MS}ms used up after {i} passes")
+                break
+
+            # Minimum face size at this pass's resolution
+            min_side = max(20, int(round(min_size * pass_scale)))
+            faces = detectors[cascade].detectMultiScale(
+                image,
+                scaleFactor=scale_factor,
+                minNeighbors=min_neighbors,
+                minSize=(min_side, min_side),
+                flags=cv2.CASCADE_SCALE_IMAGE
+            )
+
+            if len(faces) > 0:
+                # Map boxes back to full-resolution coordinates
+                faces = np.round(np.asarray(faces) / pass_scale).astype(int)
+                logger.info(f"Detected {len(faces)} faces with {cascade} pass {i + 1} at "
+                            f"{image.shape[1]}x{image.shape[0]} in {(time.perf_counter() - started) * 1000:.1f}ms")
+                return gray, faces
+
+        # Return empty result if no faces detected
+        return gray, []
+
+    except Exception as e:
+        logger.error(f"Face detection error: {str(e)}")
+        logger.error(traceback.format_exc())
+        return None, []
+
+def crop_largest_face(img_cv, gray, faces):
+    """Cut the largest detected face out of the image and normalize it to 200x200
+
+    Returns:
+        tuple: ((x, y, w, h), crop in the input's colors, equalized grayscale crop)
+    """
+    # Take the largest face if multiple detected (likely to be the main subject)
+    (x, y, w, h) = max(faces, key=lambda face: face[2] * face[3])
+
+    # Add some margin around the face (improve recognition)
+    y_margin = int(h * 0.3)  # Increased margin for better detection
+    x_margin = int(w * 0.3)  # Increased margin for better detection
+
+    # Ensure margins don't go outside image bounds
+    y_start = max(0, y - y_margin)
+    y_end = min(gray.shape[0], y + h + y_margin)
+    x_start = max(0, x - x_margin)
+    x_end = min(gray.shape[1], x + w + x_margin)
+
+    # Extract face region with margin and resize to standard size for consistency
+    face_img_resized = cv2.resize(img_cv[y_start:y_end, x_start:x_end], (200, 200))
+    face_gray_resized = cv2.resize(gray[y_start:y_end, x_start:x_end], (200, 200))
+
+    return (x, y, w, h), face_img_resized, face_gray_resized
+
+def decode_grayscale(image_binary, size=None):
+    """Decode an uploaded image straight to grayscale
+
+    Large JPEGs are scaled down by the decoder itself, by the largest factor
+    that still leaves the longest side at FACE_DETECT_MAX_SIDE or more, since
+    detection would downsample them to that size anyway.
+
+    Args:
+        image_binary: Encoded image bytes
+        size: (width, height) of the image if already known
+
+    Returns:
+        ndarray: Grayscale image, or None if it cannot be decoded
+    """
+    flag = cv2.IMREAD_GRAYSCALE
+    if size is not None:
+        # Flags that shrink the image by 8, 4 or 2 while decoding
+        for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                     (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if max(size) // factor >= FACE_DETECT_MAX_SIDE:
+                flag = reduced_flag
+                break
+    # Enrollment decodes with PIL, which keeps the stored pixel orientation,
+    # so the probe must not be rotated by its EXIF tag either
+    return cv2.imdecode(np.frombuffer(image_binary, dtype=np.uint8), flag | cv2.IMREAD_IGNORE_ORIENTATION)
+
+def encode_jpeg(image):
+    """Encode a PIL image as JPEG bytes for the face store"""
+    buffer = BytesIO()
+    image.convert('RGB').save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+# Haar cascades of a bulk enrollment worker process
+_worker_detectors = None
+
+def prepare_enrollment(phone, image_binary, detectors=None):
+    """Detect and crop the face in one bulk enrollment image
+
+    Runs in a worker process. Everything is committed for the whole batch
+    by BiometricVerifier.register_faces.
+
+    Returns:
+        dict: 'phone', 'success' and either 'error' or 'face_region',
+        'face_hash', the encoded 'images', 'face_gray' (for LBPH) and
+        'face_compare' (for the gallery)
+    """
+    global _worker_detectors
+    result = {'phone': phone, 'success': False}
+    if not phone.isdigit():
+        result['error'] = "Phone number must contain only digits"
+        return result
+
+    try:
+        image = Image.open(BytesIO(image_binary))
+        img_cv = np.array(image.convert('RGB'))[:, :, ::-1].copy()  # RGB to BGR
+    except Exception as e:
+        result['error'] = f"Cannot open image: {str(e)}"
+        return result
+
+    if detectors is None:
+        if _worker_detectors is None:
+            _worker_detectors = load_face_detectors()
+        detectors = _worker_detectors
+
+    gray, faces = detect_faces(img_cv, detectors)
+    if len(faces) == 0:
+        result['error'] = "No face detected"
+        return result
+
+    (x, y, w, h), face_img_resized, face_gray_resized = crop_largest_face(img_cv, gray, faces)
+    face_img_hash = hashlib.sha256(cv2.imencode('.jpg', face_img_resized)[1].tobytes()).hexdigest()
+
+    result.update({
+        # Same images as a single registration, stored with the batch
+        'images': {
+            'original': encode_jpeg(image),
+            'face': cv2.imencode('.jpg', face_img_resized)[1].tobytes(),
+            'face_gray': cv2.imencode('.jpg', face_gray_resized)[1].tobytes()
+        },
+        'success': True,
+        'face_region': [int(x), int(y), int(w), int(h)],
+        'face_hash': face_img_hash,
+        'face_gray': face_gray_resized,
+        'face_compare': cv2.cvtColor(face_img_resized, cv2.COLOR_BGR2GRAY)
+    })
+    return result
+
+def _enrollment_phone(name):
+    """Phone number for an enrollment image, taken from its file name"""
+    return os.path.splitext(os.path.basename(name))[0]
+
+def enrollment_items_from_dir(path):
+    """List (source, phone, image bytes) for every image in a directory"""
+    items = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(ENROLL_IMAGE_EXTENSIONS):
+            with open(os.path.join(path, name), 'rb') as f:
+                items.append((name, _enrollment_phone(name), f.read()))
+    return items
+
+def enrollment_items_from_zip(fileobj):
+    """List (source, phone, image bytes) for every image in a zip archive
+
+    Raises:
+        ValueError: If the archive exceeds the bulk enrollment limits
+    """
+    items = []
+    with zipfile.ZipFile(fileobj) as archive:
+        members = [m for m in archive.infolist()
+                   if not m.is_dir() and m.filename.lower().endswith(ENROLL_IMAGE_EXTENSIONS)]
+        if len(members) > BULK_ENROLL_MAX_IMAGES:
+            raise ValueError(f"Archive holds {len(members)} images, the limit is {BULK_ENROLL_MAX_IMAGES}")
+        if sum(m.file_size for m in members) > BULK_ENROLL_MAX_BYTES:
+            raise ValueError(f"Archive expands to more than {BULK_ENROLL_MAX_BYTES} bytes")
+        for member in members:
+            items.append((member.filename, _enrollment_phone(member.filename), archive.read(member)))
+    return items
+
+# Default location of registered faces, next to the app
+DEFAULT_FACES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'faces')
+
 class BiometricVerifier:
-    def __init__(self):
-        self.faces_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'faces')
+    def __init__(self, faces_dir=None):
+        self.faces_dir = faces_dir or DEFAULT_FACES_DIR
         # Create faces directory if it doesn't exist
         if not os.path.exists(self.faces_dir):
             os.makedirs(self.faces_dir)
@@ -44,34 +402,45 @@ class BiometricVerifier:
             
         logger.info(f"BiometricVerifier initialized with storage at {self.faces_dir}")
 
+        # Registrations and their images, migrated from the flat layout on first start
+        self.store = FaceStore(os.path.join(self.faces_dir, 'faces.db'))
+        migrate_flat_layout(self.faces_dir, self.store)
+
+        # Decoded templates of recently verified users
+        self.template_cache = FaceTemplateCache()
+
+        # Grayscale face crops of every registered user for batched matching
+        self.gallery = FaceGallery(os.path.join(self.faces_dir, 'gallery'))
+
+        # Enrollment images and LBPH training are processed in order off the request path
+        self.training_queue = ThreadPoolExecutor(max_workers=1, thread_name_prefix='face-training')
+        self.training_pending = 0
+        # Pending registrations name the process training them; it holds the
+        # owner lock for as long as it runs, so peers leave its jobs alone
+        self.training_dir = os.path.join(self.faces_dir, 'training')
+        os.makedirs(self.training_dir, exist_ok=True)
+        self.training_owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._training_owner_lock = hold_lock(self._training_owner_path(self.training_owner))
+        self._training_lock = threading.Lock()
+
         # Initialize OpenCV face detection
         try:
             import cv2
             # Use cascade classifiers - more reliable for detection
-            # Try to load both frontal and profile face cascades for better detection
-            self.face_cascade_frontal = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-            self.face_cascade_profile = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
-            # Also load eye detection for improved verification
-            self.eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+            # Cascades are not thread-safe, so each request borrows its own set
+            self.detector_pool = ResourcePool('face detector', load_face_detectors)
+            with self.detector_pool.checkout():
+                pass
             self.use_opencv = True
             logger.info("Using OpenCV cascades for face detection")
             
             # Check if advanced face recognition is available
-            try:
-                # Initialize LBPH Face Recognizer (Local Binary Patterns Histograms)
-                # This is more robust than simple image comparison
-                self.face_recognizer = cv2.face_LBPHFaceRecognizer.create()
-                self.advanced_recognition = True
+            # LBPH (Local Binary Patterns Histograms) is more robust than simple image comparison
+            self.advanced_recognition = lbph_available()
+            if self.advanced_recognition:
                 logger.info("OpenCV LBPH face recognition is available")
-            except (AttributeError, cv2.error) as e:
-                try:
-                    # Try another way to initialize the face recognizer
-                    self.face_recognizer = cv2.face.LBPHFaceRecognizer_create()
-                    self.advanced_recognition = True
-                    logger.info("OpenCV face.LBPHFaceRecognizer is available")
-                except (AttributeError, cv2.error) as e:
-                    self.advanced_recognition = False
-                    logger.info("OpenCV advanced face recognition not available, using image similarity")
+            else:
+                logger.info("OpenCV advanced face recognition not available, using image similarity")
         except Exception as e:
             self.use_opencv = False
             self.advanced_recognition = False
@@ -79,75 +448,171 @@ class BiometricVerifier:
             logger.warning("Using simplified hash-based verification")
             logger.error(traceback.format_exc())
 
+        # LBPH histograms of every registered face
+        self.recognizer = GalleryRecognizer(self.models_dir) if self.advanced_recognition else None
+
+        if self.use_opencv:
+            self._migrate_gallery()
+        if self.advanced_recognition and not self.recognizer.exists():
+            self._migrate_recognizer()
+        if self.advanced_recognition:
+            self._resume_training()
+
+    def _migrate_gallery(self):
+        """Add stored face crops of users registered before the gallery existed"""
+        added = 0
+        for phone in self.get_all_registered_users():
+            if phone in self.gallery:
+                continue
+            stored_face = self._read_stored_image(phone, 'face', cv2.IMREAD_COLOR)
+            if stored_face is None:
+                continue
+            try:
+                self.gallery.add(phone, cv2.cvtColor(stored_face, cv2.COLOR_BGR2GRAY))
+                added += 1
+            except Exception as e:
+                logger.error(f"Failed to add {phone} to face gallery: {str(e)}")
+        if added:
+            logger.info(f"Added {added} registered faces to the face gallery")
+
+    def _training_owner_path(self, owner):
+        return os.path.join(self.training_dir, f"{owner}.owner")
+
+    def _resume_training(self):
+        """Re-queue registrations whose background training never finished
+
+        A worker that exits with enrollments still queued leaves them at
+        "pending". Only registrations whose owner lock can be taken are
+        claimed, so jobs still queued in a live worker are not trained twice.
+        Their face crops are read back from the store, or from the gallery
+        when the worker exited before writing them.
+        """
+        dead_owners = {}
+        resumed = 0
+        for phone in self.get_all_registered_users():
+            metadata = self.store.get_metadata(phone)
+            if metadata is None or metadata.get('model_status') != "pending":
+                continue
+            owner = metadata.get('training_owner')
+            if owner == self.training_owner:
+                continue
+            if owner is not None:
+                if owner not in dead_owners:
+                    dead_owners[owner] = hold_lock(self._training_owner_path(owner), blocking=False)
+                if dead_owners[owner] is None:
+                    continue
+
+            with self._enrollment_lock():
+                # Another starting worker may have claimed it meanwhile
+                if self.store.get_metadata(phone) != metadata:
+                    continue
+                face_gray = self._read_stored_image(phone, 'face_gray', cv2.IMREAD_GRAYSCALE)
+                if face_gray is None:
+                    face_gray = self.gallery.get(phone)
+                    if face_gray is not None:
+                        face_gray = cv2.equalizeHist(face_gray)
+                if face_gray is None:
+                    logger.warning(f"No stored face to train the pending registration of {phone}")
+                    self._save_metadata(phone, dict(metadata, model_status="failed"))
+                    continue
+                claimed = dict(metadata, training_owner=self.training_owner)
+                self._save_metadata(phone, claimed)
+
+            # The color crop is only rewritten if it was stored
+            face_img = self._read_stored_image(phone, 'face', cv2.IMREAD_COLOR)
+            self._submit_training(phone, None, (face_img, face_gray), claimed)
+            resumed += 1
+
+        for handle in dead_owners.values():
+            if handle is not None:
+                handle.close()
+
+        # Owner files of exited workers are not needed once their jobs are claimed
+        for name in os.listdir(self.training_dir):
+            path = os.path.join(self.training_dir, name)
+            if not name.endswith('.owner') or name == f"{self.training_owner}.owner":
+                continue
+            handle = hold_lock(path, blocking=False)
+            if handle is not None:
+                os.remove(path)
+                handle.close()
+        if resumed:
+            logger.info(f"Re-queued face model training for {resumed} pending registrations")
+
+    def _migrate_recognizer(self):
+        """Train the gallery LBPH model for users enrolled before it existed
+
+        Users are retrained from their stored grayscale crop, or from the
+        gallery crop when that is missing. LBPH works on local binary
+        patterns, which histogram equalization does not change.
+        """
+        faces = {}
+        for phone in self.get_all_registered_users():
+            template = self.get_template(phone)
+            if template is None or not template['metadata'].get('has_model', False):
+                continue
+            face_gray = self._read_stored_image(phone, 'face_gray', cv2.IMREAD_GRAYSCALE)
+            if face_gray is None:
+                face_gray = self.gallery.get(phone)
+            if face_gray is not None:
+                faces[phone] = augment_face(face_gray)
+        if faces:
+            try:
+                self.recognizer.retrain(faces)
+            except Exception as e:
+                logger.error(f"Failed to build gallery face model: {str(e)}")
+                logger.error(traceback.format_exc())
+                return
+
+        # The earlier single-file LBPH model is superseded by the histogram files
+        for name in ('gallery_lbph.yml', 'gallery_labels.json'):
+            path = os.path.join(self.models_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _read_stored_image(self, phone, kind, flags):
+        """Decode an image kept in the face store, or None if there is none"""
+        data = self.store.get_image(phone, kind)
+        if data is None:
+            return None
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+    def _load_template(self, phone):
+        """Read a registered user's metadata from the face store
+
+        Returns:
+            dict: Template with 'phone' and 'metadata', or None if not registered
+        """
+        record = self.store.get_record(phone)
+        if record is None:
+            return None
+        face_data, updated_at = record
+        logger.info(f"Loaded face data for {phone}")
+
+        return {'phone': phone, 'metadata': face_data, 'updated_at': updated_at}
+
+    def _template_is_current(self, template):
+        """Check that a cached template was not re-registered by any process"""
+        return self.store.updated_at(template['phone']) == template['updated_at']
+
+    def get_template(self, phone):
+        """Return the registered face template for phone, or None"""
+        return self.template_cache.get(phone, self._load_template, version=self.store.version(),
+                                       validate=self._template_is_current)
+
     def detect_face(self, img_cv):
-        """Detect faces in image with increased accuracy by trying multiple methods"""
-        try:
-            # Convert to grayscale for detection
-            gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-            
-            # Equalize histogram to improve detection in different lighting
-            gray = cv2.equalizeHist(gray)
-            
-            # Try to detect frontal faces first with different parameters
-            # Start with more lenient parameters to detect more faces
-            faces_frontal = self.face_cascade_frontal.detectMultiScale(
-                gray,
-                scaleFactor=1.2,  # More lenient scale factor
-                minNeighbors=3,   # Fewer neighbors required
-                minSize=(30, 30),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
-            
-            # If no frontal faces found, try profile faces
-            if len(faces_frontal) == 0:
-                faces_profile = self.face_cascade_profile.detectMultiScale(
-                    gray,
-                    scaleFactor=1.2,  # More lenient scale factor
-                    minNeighbors=3,   # Fewer neighbors required
-                    minSize=(30, 30),
-                    flags=cv2.CASCADE_SCALE_IMAGE
-                )
-                
-                # If profile faces found, use them
-                if len(faces_profile) > 0:
-                    return gray, faces_profile
-                
-                # Try with even more lenient parameters if still no faces
-                faces_lenient = self.face_cascade_frontal.detectMultiScale(
-                    gray,
-                    scaleFactor=1.3,    # Even more lenient scale factor
-                    minNeighbors=2,     # Even fewer neighbors
-                    minSize=(20, 20),   # Smaller minimum size
-                    flags=cv2.CASCADE_SCALE_IMAGE
-                )
-                
-                if len(faces_lenient) > 0:
-                    return gray, faces_lenient
-                    
-                # Return empty result if no faces detected
-                return gray, []
-            
-            # Return result with frontal faces (most reliable)
-            return gray, faces_frontal
-            
-        except Exception as e:
-            logger.error(f"Face detection error: {str(e)}")
-            logger.error(traceback.format_exc())
-            return None, []
+        """Detect faces in image with increased accuracy by trying multiple methods
+
+        Returns:
+            tuple: (equalized full-resolution grayscale image, face boxes)
+        """
+        with self.detector_pool.checkout() as detectors:
+            return detect_faces(img_cv, detectors)
 
     def get_all_registered_users(self):
         """Return a list of all registered users (phone numbers)"""
         try:
-            # Get all JSON files in the faces directory
-            json_files = glob.glob(os.path.join(self.faces_dir, "*.json"))
-            # Extract phone numbers from filenames
-            users = []
-            for json_file in json_files:
-                phone = os.path.basename(json_file).replace(".json", "")
-                # Verify it's a valid phone number (all digits)
-                if phone.isdigit():
-                    users.append(phone)
-            return users
+            return self.store.phones()
         except Exception as e:
             logger.error(f"Error getting registered users: {str(e)}")
             return []
@@ -185,120 +650,17 @@ class BiometricVerifier:
                     
                     if len(faces) > 0:
                         face_found = True
-                        # Take the largest face if multiple detected (likely to be the main subject)
+                        (x, y, w, h), face_img_resized, face_gray_resized = crop_largest_face(img_cv, gray, faces)
                         if len(faces) > 1:
-                            # Find the largest face by area (width * height)
-                            largest_area = 0
-                            largest_idx = 0
-                            for i, (x, y, w, h) in enumerate(faces):
-                                area = w * h
-                                if area > largest_area:
-                                    largest_area = area
-                                    largest_idx = i
-                            
-                            # Use the largest face
-                            (x, y, w, h) = faces[largest_idx]
                             logger.info(f"Multiple faces detected, using the largest one at {x},{y},{w},{h}")
-                        else:
-                            # Just use the only face
-                            (x, y, w, h) = faces[0]
-                        
-                        # Add some margin around the face (improve recognition)
-                        y_margin = int(h * 0.3)  # Increased margin for better detection
-                        x_margin = int(w * 0.3)  # Increased margin for better detection
-                        
-                        # Ensure margins don't go outside image bounds
-                        y_start = max(0, y - y_margin)
-                        y_end = min(gray.shape[0], y + h + y_margin)
-                        x_start = max(0, x - x_margin)
-                        x_end = min(gray.shape[1], x + w + x_margin)
-                        
-                        # Extract face region with margin
-                        face_img = img_cv[y_start:y_end, x_start:x_end]
-                        face_gray = gray[y_start:y_end, x_start:x_end]
-                        
-                        # Resize to standard size for consistency
-                        face_img_resized = cv2.resize(face_img, (200, 200))
-                        face_gray_resized = cv2.resize(face_gray, (200, 200))
-                        
-                        # Save the face images for future comparison
-                        face_img_path = os.path.join(self.faces_dir, f"{phone}_face.jpg")
-                        cv2.imwrite(face_img_path, face_img_resized)
-                        
-                        # Also save grayscale version
-                        face_gray_path = os.path.join(self.faces_dir, f"{phone}_face_gray.jpg")
-                        cv2.imwrite(face_gray_path, face_gray_resized)
                         
-                        logger.info(f"Saved face image to {face_img_path}")
+                        # Keep the gallery used for batched SSIM/MSE matching current
+                        self.gallery.add(phone, cv2.cvtColor(face_img_resized, cv2.COLOR_BGR2GRAY))
                         
                         # Calculate face image hash for backup comparison
                         face_img_encoded = cv2.imencode('.jpg', face_img_resized)[1].tobytes()
                         face_img_hash = hashlib.sha256(face_img_encoded).hexdigest()
                         
-                        # If LBPH recognizer available, train it with this face
-                        if self.advanced_recognition:
-                            try:
-                                # Create a model file path specific to this user
-                                model_path = os.path.join(self.models_dir, f"{phone}_model.yml")
-                                
-                                # Store multiple samples for better recognition
-                                samples = []
-                                labels = []
-                                
-                                # Add current face as multiple samples with small variations for robustness
-                                base_face = face_gray_resized
-                                
-                                # Add the base face
-                                samples.append(base_face)
-                                labels.append(1)  # Label 1 for the registered face
-                                
-                                # Add slightly rotated versions
-                                rows, cols = base_face.shape
-                                center = (cols // 2, rows // 2)
-                                
-                                # Add more rotated versions for better recognition
-                                for angle in [-15, -10, -5, 5, 10, 15]:
-                                    rotation_matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
-                                    rotated = cv2.warpAffine(base_face, rotation_matrix, (cols, rows))
-                                    samples.append(rotated)
-                                    labels.append(1)
-                                
-                                # Also add slightly scaled versions
-                                for scale in [0.9, 0.95, 1.05, 1.1]:
-                                    scaled_size = (int(cols * scale), int(rows * scale))
-                                    scaled = cv2.resize(base_face, scaled_size)
-                                    # Make sure it's the right size again
-                                    if scale < 1.0:
-                                        # Pad if smaller
-                                        pad_h = (200 - scaled.shape[0]) // 2
-                                        pad_w = (200 - scaled.shape[1]) // 2
-                                        scaled_padded = cv2.copyMakeBorder(scaled, pad_h, pad_h, pad_w, pad_w,
-                                                                          cv2.BORDER_CONSTANT, value=0)
-                                        samples.append(scaled_padded)
-                                    else:
-                                        # Crop if larger
-                                        start_h = (scaled.shape[0] - 200) // 2
-                                        start_w = (scaled.shape[1] - 200) // 2
-                                        scaled_cropped = scaled[start_h:start_h+200, start_w:start_w+200]
-                                        samples.append(scaled_cropped)
-                                    labels.append(1)
-                                
-                                # Add brightness variations
-                                for alpha in [0.8, 1.2]:  # Darker and lighter versions
-                                    bright_adj = cv2.convertScaleAbs(base_face, alpha=alpha, beta=0)
-                                    samples.append(bright_adj)
-                                    labels.append(1)
-                                
-                                # Train the recognizer
-                                self.face_recognizer.train(samples, np.array(labels))
-                                
-                                # Save the model
-                                self.face_recognizer.save(model_path)
-                                logger.info(f"Trained and saved face recognition model to {model_path}")
-                            except Exception as e:
-                                logger.error(f"Failed to train face recognizer: {str(e)}")
-                                logger.error(traceback.format_exc())
-                        
                         # Store face data
                         face_data = {
                             "phone": phone,
@@ -306,10 +668,15 @@ class BiometricVerifier:
                             "face_hash": face_img_hash,
                             "timestamp": datetime.now().isoformat(),
                             "method": "opencv_enhanced",
-                            "has_model": self.advanced_recognition
+                            # The LBPH model is trained in the background
+                            "has_model": False,
+                            "model_status": "pending" if self.advanced_recognition else "unavailable",
+                            "training_owner": self.training_owner
                         }
                     else:
                         logger.warning(f"No face detected with OpenCV for {phone}")
+                except PoolTimeout:
+                    raise
                 except Exception as e:
                     logger.error(f"OpenCV face detection failed: {str(e)}")
                     logger.error(traceback.format_exc())
@@ -325,248 +692,515 @@ class BiometricVerifier:
                     "method": "hash"
                 }
 
-            # Save to file
+            # Save to file; queued training jobs of an older registration see it and stop
             try:
-                filepath = os.path.join(self.faces_dir, f"{phone}.json")
-                with open(filepath, 'w') as f:
-                    json.dump(face_data, f)
-                logger.info(f"Face data saved to {filepath}")
+                with self._enrollment_lock():
+                    self._save_metadata(phone, face_data)
             except Exception as e:
                 logger.error(f"Failed to save face data: {str(e)}")
                 logger.error(traceback.format_exc())
                 return False
 
-            # Also save the original image
-            try:
-                img_path = os.path.join(self.faces_dir, f"{phone}.jpg")
-                image.save(img_path, format="JPEG")
-                logger.info(f"Image saved to {img_path}")
-            except Exception as e:
-                logger.error(f"Failed to save image: {str(e)}")
-                logger.error(traceback.format_exc())
-                # Continue as this is not critical
+            # Make the next verification pick up the new registration
+            self.template_cache.invalidate(phone)
+
+            # Image files and model training do not hold up the response
+            face_images = (face_img_resized, face_gray_resized) if face_found else None
+            self._submit_training(phone, image, face_images, face_data)
 
             logger.info(f"Face registered for {phone} using method: {face_data.get('method', 'unknown')}")
             return True
+        except PoolTimeout:
+            raise
         except Exception as e:
             logger.error(f"Error in register_face: {str(e)}")
             logger.error(traceback.format_exc())
             return False
 
-    def verify_against_specific_user(self, phone, image_binary):
-        """Verify a face against a specific registered user's face"""
-        try:
-            # Load registered face data
-            filepath = os.path.join(self.faces_dir, f"{phone}.json")
-            if not os.path.exists(filepath):
-                logger.warning(f"No face registered for {phone}")
-                return False
-                
-            # Load the image for verification
+    def register_faces(self, items, workers=None):
+        """Register many faces at once, e.g. when onboarding staff
+
+        Detection and cropping run across a process pool. The gallery, the
+        LBPH model and the metadata are then committed for the whole batch
+        in one pass.
+
+        Args:
+            items: (source, phone, image bytes) tuples; source names the image in the report
+            workers: Worker processes (default BULK_ENROLL_WORKERS)
+
+        Returns:
+            list: One report entry per item, in order, with 'source', 'phone',
+            'success' and 'error' or 'face_region'
+        """
+        items = list(items)
+        workers = min(workers or BULK_ENROLL_WORKERS, max(1, len(items)))
+        if not self.use_opencv:
+            return [{'source': source, 'phone': phone, 'success': False, 'error': "Face detection unavailable"}
+                    for source, phone, _ in items]
+
+        # Only the last image of a phone number is enrolled
+        last_index = {phone: i for i, (_, phone, _) in enumerate(items)}
+        todo = [i for i, (_, phone, _) in enumerate(items) if last_index[phone] == i]
+
+        started = time.perf_counter()
+        prepared = None
+        if workers > 1:
             try:
-                image = Image.open(BytesIO(image_binary))
-                logger.info(f"Verification image opened successfully: format={image.format}, size={image.size}")
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    prepared = list(executor.map(
+                        prepare_enrollment,
+                        [items[i][1] for i in todo], [items[i][2] for i in todo],
+                        chunksize=max(1, len(todo) // (workers * 4))
+                    ))
+            except BrokenProcessPool as e:
+                logger.warning(f"Bulk enrollment pool failed, enrolling in-process instead: {str(e)}")
+        if prepared is None:
+            with self.detector_pool.checkout() as detectors:
+                prepared = [prepare_enrollment(items[i][1], items[i][2], detectors) for i in todo]
+        logger.info(f"Prepared {len(todo)} enrollment images with {workers} workers "
+                    f"in {time.perf_counter() - started:.2f}s")
+
+        results = dict(zip(todo, prepared))
+        enrolled = [result for result in prepared if result['success']]
+
+        # Commit the batch: gallery rows, one model update, then metadata
+        self.gallery.add_many({result['phone']: result['face_compare'] for result in enrolled})
+        with self._enrollment_lock():
+            model_status = self._commit_bulk_enrollment(enrolled)
+        for result in enrolled:
+            self.template_cache.invalidate(result['phone'])
+
+        report = []
+        for i, (source, phone, _) in enumerate(items):
+            entry = {'source': source, 'phone': phone}
+            result = results.get(i)
+            if result is None:
+                entry.update(success=False, error="Superseded by a later image for the same phone")
+            elif result['success']:
+                entry.update(success=True, face_region=result['face_region'], model_status=model_status)
+            else:
+                entry.update(success=False, error=result['error'])
+            report.append(entry)
+
+        logger.info(f"Bulk enrollment registered {len(enrolled)} of {len(items)} images "
+                    f"in {time.perf_counter() - started:.2f}s")
+        return report
+
+    def _commit_bulk_enrollment(self, enrolled):
+        """Add a prepared batch to the LBPH model and write its metadata
+
+        Returns:
+            str: The model status recorded for the batch
+        """
+        model_status = "unavailable"
+        if self.advanced_recognition and enrolled:
+            try:
+                for start in range(0, len(enrolled), 64):
+                    self.recognizer.enroll_many(
+                        {result['phone']: augment_face(result['face_gray']) for result in enrolled[start:start + 64]})
+                model_status = "ready"
             except Exception as e:
-                logger.error(f"Failed to open verification image: {str(e)}")
+                model_status = "failed"
+                logger.error(f"Failed to train face recognizer for bulk enrollment: {str(e)}")
                 logger.error(traceback.format_exc())
-                return False
 
-            # Load registered face data
+        timestamp = datetime.now().isoformat()
+        self.store.put_many([(result['phone'], {
+            "phone": result['phone'],
+            "face_region": result['face_region'],
+            "face_hash": result['face_hash'],
+            "timestamp": timestamp,
+            "method": "opencv_enhanced",
+            "has_model": model_status == "ready",
+            "model_status": model_status
+        }, result['images']) for result in enrolled])
+        return model_status
+
+    def _save_metadata(self, phone, face_data):
+        """Write a user's face metadata to the face store"""
+        self.store.put_metadata(phone, face_data)
+        logger.info(f"Face data saved for {phone}")
+
+    def _submit_training(self, phone, image, face_images, face_data):
+        """Queue the background part of an enrollment"""
+        with self._training_lock:
+            self.training_pending += 1
+        future = self.training_queue.submit(self._finish_enrollment, phone, image, face_images, face_data)
+        future.add_done_callback(self._training_done)
+        return future
+
+    def _training_done(self, future):
+        with self._training_lock:
+            self.training_pending -= 1
+        if future.exception() is not None:
+            logger.error(f"Face enrollment job failed: {future.exception()}")
+
+    def _enrollment_lock(self):
+        """Lock held while enrollments change the LBPH model and the stored faces"""
+        return self.recognizer.locked() if self.recognizer is not None else nullcontext()
+
+    def _is_current(self, phone, face_data):
+        """Check that face_data is still the stored registration of phone
+
+        Reads the store, not the template cache, so registrations made by
+        other processes are seen as well.
+        """
+        current = self.store.get_metadata(phone)
+        if current is None:
+            return False
+        return all(current.get(key) == face_data.get(key) for key in ('method', 'face_hash', 'image_hash', 'timestamp'))
+
+    def _finish_enrollment(self, phone, image, face_images, face_data):
+        """Write the enrollment images and train the LBPH model for a user
+
+        Runs on the training queue and tells the training listeners the
+        resulting model status. A job whose registration was replaced while
+        it waited is dropped before it writes anything, so an old face can
+        never overwrite the images or model samples of a newer one.
+        """
+        with self._enrollment_lock():
+            if not self._is_current(phone, face_data):
+                logger.info(f"Dropping superseded enrollment job for {phone}")
+                return None
+
+            # Also save the original image (a resumed enrollment no longer has it)
+            if image is not None:
+                try:
+                    self.store.put_images(phone, {'original': encode_jpeg(image)})
+                    logger.info(f"Image saved for {phone}")
+                except Exception as e:
+                    logger.error(f"Failed to save image: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    # Continue as this is not critical
+
+            status = face_data.get('model_status', 'unavailable')
+            if face_images is not None:
+                status = self._train_enrollment(phone, face_images, face_data)
+
+        for listener in list(_training_listeners):
             try:
-                with open(filepath, 'r') as f:
-                    face_data = json.load(f)
-                logger.info(f"Loaded face data from {filepath}")
-                logger.info(f"Registration method was: {face_data.get('method', 'unknown')}")
+                listener(phone, status)
             except Exception as e:
-                logger.error(f"Failed to load registered face data: {str(e)}")
+                logger.error(f"Face training listener failed: {str(e)}")
+        return status
+
+    def _train_enrollment(self, phone, face_images, face_data):
+        """Save the face crops and add them to the gallery LBPH model
+
+        The caller holds the enrollment lock and has checked that face_data
+        is still the current registration.
+        """
+        face_img_resized, face_gray_resized = face_images
+
+        # Save the face images for future comparison, with a grayscale version
+        images = {'face_gray': cv2.imencode('.jpg', face_gray_resized)[1].tobytes()}
+        if face_img_resized is not None:
+            images['face'] = cv2.imencode('.jpg', face_img_resized)[1].tobytes()
+        self.store.put_images(phone, images)
+        logger.info(f"Saved face images for {phone}")
+
+        if not self.advanced_recognition:
+            return face_data['model_status']
+
+        # Add this face to the gallery model, trained with multiple samples
+        # with small variations for robustness
+        started = time.perf_counter()
+        try:
+            self.recognizer.enroll(phone, augment_face(face_gray_resized))
+            status = "ready"
+            logger.info(f"Trained face model for {phone} in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            status = "failed"
+            logger.error(f"Failed to train face recognizer: {str(e)}")
+            logger.error(traceback.format_exc())
+
+        updated = dict(self.store.get_metadata(phone), has_model=status == "ready", model_status=status)
+        self._save_metadata(phone, updated)
+        self.template_cache.invalidate(phone)
+        return status
+
+    def wait_for_training(self, timeout=None):
+        """Block until every enrollment queued so far has been processed"""
+        self.training_queue.submit(lambda: None).result(timeout)
+
+    def prepare_probe(self, image_binary):
+        """Decode a verification image and normalize its face once
+
+        The result can be compared against any number of stored templates
+        without decoding the image or running face detection again.
+
+        Returns:
+            dict: Probe with 'image_hash' and, when a face was found,
+            'face_gray' (for LBPH) and 'face_compare' (for SSIM/MSE); None if
+            the image cannot be opened
+        """
+        try:
+            # Only reads the header; pixels are decoded by OpenCV below
+            image = Image.open(BytesIO(image_binary))
+            logger.info(f"Verification image opened successfully: format={image.format}, size={image.size}")
+        except Exception as e:
+            logger.error(f"Failed to open verification image: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+
+        probe = {'image_hash': hashlib.sha256(image_binary).hexdigest(), 'face_gray': None, 'face_compare': None}
+
+        if self.use_opencv:
+            try:
+                # Only grayscale is compared, so decode straight to it at reduced size
+                img_gray = decode_grayscale(image_binary, image.size)
+                if img_gray is None:
+                    logger.error("OpenCV could not decode verification image")
+                    return None
+
+                # Enhanced face detection
+                gray, faces = self.detect_face(img_gray)
+                logger.info(f"OpenCV verification found {len(faces)} faces")
+
+                if len(faces) > 0:
+                    _, face_img_resized, face_gray_resized = crop_largest_face(img_gray, gray, faces)
+                    probe['face_gray'] = face_gray_resized
+                    probe['face_compare'] = face_img_resized
+                else:
+                    logger.warning(f"No face detected in verification image")
+            except PoolTimeout:
+                raise
+            except Exception as e:
+                logger.error(f"OpenCV verification failed: {str(e)}")
                 logger.error(traceback.format_exc())
-                return False
-                
-            # Use OpenCV-based verification methods
-            if self.use_opencv and (face_data.get('method', 'unknown') == 'opencv' or 
-                                   face_data.get('method', 'unknown') == 'opencv_enhanced'):
+
+        return probe
+
+    def score_template(self, probe, template, exhaustive=False, similarity=None, lbph_distances=None):
+        """Compare a prepared probe with a stored template
+
+        Methods are tried in order (LBPH, then SSIM, then image hash) and
+        scoring stops at the first match unless exhaustive is set. Gallery
+        scores and LBPH distances already computed for the probe can be
+        passed in as similarity and lbph_distances.
+
+        Returns:
+            dict: 'matched', the 'method' that matched and every score computed
+        """
+        face_data = template['metadata']
+        result = {'matched': False, 'method': None}
+
+        def matched(method):
+            result['matched'] = True
+            result['method'] = result['method'] or method
+            return not exhaustive
+
+        # Use OpenCV-based verification methods
+        if face_data.get('method', 'unknown') in ('opencv', 'opencv_enhanced') and probe['face_gray'] is not None:
+            # First try LBPH recognition if available and the user is in the gallery model
+            if self.advanced_recognition and face_data.get('has_model', False):
                 try:
-                    # Convert PIL image to OpenCV format
-                    img_cv = np.array(image.convert('RGB'))
-                    img_cv = img_cv[:, :, ::-1].copy()  # RGB to BGR
-                    
-                    # Enhanced face detection
-                    gray, faces = self.detect_face(img_cv)
-                    
-                    logger.info(f"OpenCV verification found {len(faces)} faces")
-                    
-                    if len(faces) > 0:
-                        # Take the largest face if multiple detected
-                        if len(faces) > 1:
-                            # Find the largest face by area
-                            largest_area = 0
-                            largest_idx = 0
-                            for i, (x, y, w, h) in enumerate(faces):
-                                area = w * h
-                                if area > largest_area:
-                                    largest_area = area
-                                    largest_idx = i
-                            
-                            # Use the largest face
-                            (x, y, w, h) = faces[largest_idx]
-                        else:
-                            # Just use the only face
-                            (x, y, w, h) = faces[0]
-                            
-                        # Add margin around face (same as in registration)
-                        y_margin = int(h * 0.3)  # Increased margin
-                        x_margin = int(w * 0.3)  # Increased margin
-                        
-                        # Ensure margins don't go outside image bounds
-                        y_start = max(0, y - y_margin)
-                        y_end = min(gray.shape[0], y + h + y_margin)
-                        x_start = max(0, x - x_margin)
-                        x_end = min(gray.shape[1], x + w + x_margin)
-                        
-                        # Extract face region with margin
-                        face_img = img_cv[y_start:y_end, x_start:x_end]
-                        face_gray = gray[y_start:y_end, x_start:x_end]
-                        
-                        # Resize to standard size for consistency
-                        face_img_resized = cv2.resize(face_img, (200, 200))
-                        face_gray_resized = cv2.resize(face_gray, (200, 200))
-                        
-                        # First try LBPH recognition if available and model exists
-                        model_path = os.path.join(self.models_dir, f"{phone}_model.yml")
-                        
-                        if self.advanced_recognition and os.path.exists(model_path) and face_data.get('has_model', False):
-                            try:
-                                # Load the trained model for this user
-                                self.face_recognizer.read(model_path)
-                                
-                                # Predict using the model
-                                label, confidence = self.face_recognizer.predict(face_gray_resized)
-                                
-                                logger.info(f"Face recognition confidence: {confidence} (lower is better)")
-                                
-                                # Check if confidence is below threshold - use more permissive threshold
-                                # Adjust threshold based on testing - lower means more strict matching
-                                threshold = 100.0  # Increased from 80 to 100 for more lenient matching
-                                if label == 1 and confidence < threshold:  # 1 is the label we used in training
-                                    logger.info(f"Face verified with LBPH recognizer: confidence={confidence}, threshold={threshold}")
-                                    return True
-                                else:
-                                    logger.info(f"Face not verified with LBPH: confidence={confidence} > threshold={threshold}")
-                                    # Continue to try other methods
-                            except Exception as e:
-                                logger.error(f"LBPH face recognition failed: {str(e)}")
-                                logger.error(traceback.format_exc())
-                                # Continue to try other methods
-                        
-                        # Try image similarity as backup
-                        # Load the stored face image
-                        stored_face_path = os.path.join(self.faces_dir, f"{phone}_face.jpg")
-                        if os.path.exists(stored_face_path):
-                            # Load stored face
-                            stored_face = cv2.imread(stored_face_path)
-                            
-                            # Compare images using structural similarity
-                            if stored_face is not None and stored_face.shape == face_img_resized.shape:
-                                # Convert images to grayscale for comparison
-                                stored_gray = cv2.cvtColor(stored_face, cv2.COLOR_BGR2GRAY)
-                                current_gray = cv2.cvtColor(face_img_resized, cv2.COLOR_BGR2GRAY)
-                                
-                                # Calculate structural similarity index
-                                try:
-                                    import skimage.metrics
-                                    ssim = skimage.metrics.structural_similarity(stored_gray, current_gray)
-                                    logger.info(f"SSIM similarity score: {ssim}")
-                                    
-                                    # Higher score means more similar - adjust threshold
-                                    # Lower threshold more for increased matching
-                                    ssim_threshold = 0.35  # Reduced from 0.45 for even more lenient matching
-                                    if ssim > ssim_threshold:
-                                        logger.info(f"SSIM verification result: True (threshold: {ssim_threshold})")
-                                        return True
-                                except ImportError:
-                                    # Fallback to MSE
-                                    mse = np.mean((stored_gray - current_gray) ** 2)
-                                    logger.info(f"MSE similarity score: {mse}")
-                                    
-                                    # Lower MSE means more similar
-                                    # Increase threshold for more lenient matching
-                                    mse_threshold = 4000  # Increased from 3000 for more lenient matching
-                                    if mse < mse_threshold:
-                                        logger.info(f"MSE verification result: True (threshold: {mse_threshold})")
-                                        return True
-                            else:
-                                logger.warning(f"Stored face not found or dimensions don't match")
+                    # Distance to the closest training sample of this user; 1:1
+                    # checks only read the claimed user's samples
+                    if lbph_distances is None:
+                        lbph_distances = self.recognizer.distances(probe['face_gray'], phones=[template['phone']])
+                    confidence = lbph_distances.get(template['phone'])
+                    if confidence is not None:
+                        result['lbph_confidence'] = confidence
+                        logger.info(f"Face recognition confidence: {confidence} (lower is better)")
+
+                        # Lower confidence means a closer match
+                        if confidence < LBPH_THRESHOLD:
+                            logger.info(f"Face verified with LBPH recognizer: confidence={confidence}, threshold={LBPH_THRESHOLD}")
+                            if matched('lbph'):
+                                return result
                         else:
-                            logger.warning(f"Stored face image not found at {stored_face_path}")
-                    else:
-                        logger.warning(f"No face detected in verification image")
+                            logger.info(f"Face not verified with LBPH: confidence={confidence} > threshold={LBPH_THRESHOLD}")
+                except PoolTimeout:
+                    raise
                 except Exception as e:
-                    logger.error(f"OpenCV verification failed: {str(e)}")
+                    logger.error(f"LBPH face recognition failed: {str(e)}")
                     logger.error(traceback.format_exc())
-            
-            # Fallback to hash comparison if still not verified
-            if face_data.get('method', 'unknown') == 'hash':
-                logger.info("Using hash-based method for verification (fallback)")
-                image_hash = hashlib.sha256(image_binary).hexdigest()
-                logger.info(f"Generated hash for verification image: {image_hash[:10]}...")
-                
-                stored_hash = face_data.get("image_hash", "")
-                logger.info(f"Retrieved stored hash: {stored_hash[:10]}...")
-                
-                if "image_hash" in face_data and image_hash == face_data["image_hash"]:
-                    logger.info(f"Hash comparison result: True")
-                    return True
-                    
+
+            # Try image similarity as backup against the stored face in the gallery
+            if similarity is None:
+                similarity = self.gallery.score(probe['face_compare'], [template['phone']]).get(template['phone'])
+            if similarity is not None:
+                result.update(similarity)
+                logger.info(f"SSIM similarity score: {similarity['ssim']}, MSE: {similarity['mse']}")
+
+                # Higher score means more similar
+                if similarity['ssim'] > SSIM_THRESHOLD:
+                    logger.info(f"SSIM verification result: True (threshold: {SSIM_THRESHOLD})")
+                    if matched('ssim'):
+                        return result
+            else:
+                logger.warning(f"Stored face not found in the gallery")
+
+        # Fallback to hash comparison
+        if face_data.get('method', 'unknown') == 'hash':
+            logger.info("Using hash-based method for verification (fallback)")
+            if "image_hash" in face_data and probe['image_hash'] == face_data["image_hash"]:
+                logger.info(f"Hash comparison result: True")
+                matched('hash')
+
+        return result
+
+    def verify_against_specific_user(self, phone, image_binary, probe=None):
+        """Verify a face against a specific registered user's face"""
+        try:
+            # Load registered face template (cached after the first verification)
+            template = self.get_template(phone)
+            if template is None:
+                logger.warning(f"No face registered for {phone}")
+                return False
+            logger.info(f"Registration method was: {template['metadata'].get('method', 'unknown')}")
+
+            if probe is None:
+                probe = self.prepare_probe(image_binary)
+                if probe is None:
+                    return False
+
+            if self.score_template(probe, template)['matched']:
+                return True
+
             # If we got here, verification failed
             logger.warning(f"Face verification failed for {phone}")
             return False
+        except PoolTimeout:
+            raise
         except Exception as e:
             logger.error(f"Error in verify_against_specific_user: {str(e)}")
             logger.error(traceback.format_exc())
             return False
 
+    def identify_face(self, image_binary, top_k=5, exclude=None, probe=None):
+        """Identify a face against every registered user (1:N)
+
+        The probe face is decoded, detected and normalized once and then
+        scored against each template in the gallery.
+
+        Returns:
+            list: Up to top_k candidates, best first, each a dict with
+            'phone', 'matched', 'method' and the computed scores
+        """
+        if probe is None:
+            probe = self.prepare_probe(image_binary)
+            if probe is None:
+                return []
+
+        # SSIM and MSE against the whole gallery in one batched pass, and
+        # LBPH distances to every identity in one chunked NumPy scan
+        similarities = {}
+        lbph_distances = {}
+        if probe['face_compare'] is not None:
+            similarities = self.gallery.score(probe['face_compare'])
+            if self.advanced_recognition:
+                lbph_distances = self.recognizer.distances(probe['face_gray'])
+
+        candidates = []
+        for phone in self.get_all_registered_users():
+            if phone == exclude:
+                continue
+            template = self.get_template(phone)
+            if template is None:
+                continue
+            candidates.append({'phone': phone, **self.score_template(
+                probe, template, exhaustive=True, similarity=similarities.get(phone),
+                lbph_distances=lbph_distances)})
+
+        # Matches first, then by similarity and LBPH distance
+        candidates.sort(key=lambda c: (
+            c['matched'],
+            c.get('ssim', -1.0),
+            -c.get('mse', float('inf')),
+            -c.get('lbph_confidence', float('inf'))
+        ), reverse=True)
+        return candidates[:top_k]
+
     def verify_face(self, phone, image_binary):
         """Verify a face against a registered face or all registered faces
         
         First attempts verification against specified phone number,
-        and if that fails, tries all other registered users.
+        and if no face is registered for it, identifies the face among all
+        registered users.
         """
         try:
             # Log input parameters (excluding binary data)
             logger.info(f"Starting face verification for phone: {phone}, image size: {len(image_binary)} bytes")
+
+            # Decode and detect the probe face once for every comparison below
+            probe = self.prepare_probe(image_binary)
+            if probe is None:
+                return False
             
             # First, try to verify against the specified user
-            verified = self.verify_against_specific_user(phone, image_binary)
+            if self.get_template(phone) is not None:
+                verified = self.verify_against_specific_user(phone, image_binary, probe=probe)
+                if verified:
+                    logger.info(f"Face verification successful for {phone}")
+                # The specified user exists, so there is no fallback to other users
+                return verified
             
-            if verified:
-                logger.info(f"Face verification successful for {phone}")
+            # No registration for this phone, identify among all registered users
+            logger.warning(f"No face registered for {phone}, trying against all registered users")
+            matches = self.identify_face(image_binary, top_k=1, exclude=phone, probe=probe)
+            if matches and matches[0]['matched']:
+                logger.info(f"Face matched with registered user: {matches[0]['phone']}")
                 return True
-            
-            # If not verified and specific user registration exists, try against all other registered users
-            filepath = os.path.join(self.faces_dir, f"{phone}.json")
-            if not os.path.exists(filepath):
-                logger.warning(f"No face registered for {phone}, trying against all registered users")
-                
-                # Get all registered users
-                all_users = self.get_all_registered_users()
-                
-                # Try verification against all other users
-                for other_phone in all_users:
-                    if other_phone != phone:  # Skip the original phone number
-                        logger.info(f"Trying verification against {other_phone}")
-                        verified = self.verify_against_specific_user(other_phone, image_binary)
-                        if verified:
-                            logger.info(f"Face matched with registered user: {other_phone}")
-                            return True
-                
-                # If we got here, verification failed against all users
-                logger.warning("Face not recognized among any registered users")
-                return False
-            else:
-                # The specified user exists but verification failed
-                return False
 
+            # If we got here, verification failed against all users
+            logger.warning("Face not recognized among any registered users")
+            return False
+
+        except PoolTimeout:
+            raise
         except Exception as e:
             logger.error(f"Error in verify_face: {str(e)}")
             logger.error(traceback.format_exc())
-            return False
\ No newline at end of file
+            return False
+
+    def stats(self):
+        """Return pool utilization, cache and gallery counters"""
+        stats = {
+            'registered_faces': len(self.gallery),
+            'training_pending': self.training_pending,
+            'template_cache': self.template_cache.stats()
+        }
+        if self.use_opencv:
+            stats['detector_pool'] = self.detector_pool.stats()
+        if self.advanced_recognition:
+            stats['recognizer'] = self.recognizer.stats()
+        return stats
+
+_shared_verifier = None
+_shared_verifier_lock = threading.Lock()
+
+def get_biometric_verifier():
+    """Return the process-wide BiometricVerifier, created on first use"""
+    global _shared_verifier
+    if _shared_verifier is None:
+        with _shared_verifier_lock:
+            if _shared_verifier is None:
+                _shared_verifier = BiometricVerifier()
+    return _shared_verifier
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="RailGuard face enrollment tools")
+    parser.add_argument("--dir", help="Faces directory (defaults to ./faces)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    enroll_parser = subparsers.add_parser("enroll", help="Register every image in a directory, named <phone>.jpg")
+    enroll_parser.add_argument("directory", help="Directory of face images")
+    enroll_parser.add_argument("--workers", type=int, help="Worker processes for detection")
+    enroll_parser.add_argument("--report", help="Also write the per-image report to this JSON file")
+    args = parser.parse_args()
+
+    if args.command == "enroll":
+        report = BiometricVerifier(args.dir).register_faces(enrollment_items_from_dir(args.directory), workers=args.workers)
+        output = json.dumps(report, indent=2)
+        print(output)
+        if args.report:
+            with open(args.report, 'w') as f:
+                f.write(output + '\n')
+        failed = sum(1 for entry in report if not entry['success'])
+        print(f"Enrolled {len(report) - failed} of {len(report)} images", file=sys.stderr)
+        raise SystemExit(1 if failed else 0)
@@ -1,33 +1,319 @@
+import atexit
 import logging
 import hashlib
 import os
 import json
 import binascii
+import multiprocessing
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from datetime import datetime
 from eth_hash.auto import keccak
 
+from utils.ledger import FILE_LOCKING_AVAILABLE, LedgerFile, migrate_json_chain
+from utils.mining import Miner, hash_block
+
+if FILE_LOCKING_AVAILABLE:
+    import fcntl
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
+DEFAULT_BLOCKCHAIN_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'blockchain')
+
+# Optimistic mining attempts before a writer mines while holding the ledger lock
+MINE_RETRIES = int(os.environ.get("BLOCKCHAIN_MINE_RETRIES", "3"))
+
+def compute_tid_hash(phone, timestamp, salt):
+    """Derive the public Trust ID hash from its block data"""
+    return keccak(f"{phone}:{timestamp}:{salt}".encode()).hex()
+
+def hash_transaction(tx):
+    """Create the SHA-256 Merkle leaf hash of a transaction"""
+    return hashlib.sha256(json.dumps(tx, sort_keys=True).encode()).hexdigest()
+
+def _merkle_parent(left, right):
+    """Hash two sibling Merkle nodes into their parent"""
+    return hashlib.sha256(bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def _merkle_levels(leaves):
+    """Build every level of a Merkle tree, leaves first
+
+    An odd node at the end of a level is paired with itself.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = level + [level[-1]]
+        levels.append([_merkle_parent(level[i], level[i + 1]) for i in range(0, len(level), 2)])
+    return levels
+
+def merkle_root(leaves):
+    """Compute the Merkle root of a list of leaf hashes"""
+    return _merkle_levels(leaves)[-1][0]
+
+def merkle_proof(leaves, position):
+    """Build the inclusion proof for the leaf at the given position
+
+    Returns:
+        list: Sibling hashes from the leaf up, each with the side it sits on
+    """
+    proof = []
+    for level in _merkle_levels(leaves)[:-1]:
+        sibling = position ^ 1
+        if sibling >= len(level):
+            sibling = position
+        proof.append({'hash': level[sibling], 'side': 'left' if sibling < position else 'right'})
+        position //= 2
+    return proof
+
+def verify_merkle_proof(leaf, proof, root):
+    """Check an inclusion proof against a Merkle root"""
+    node = leaf
+    for step in proof:
+        if step['side'] == 'left':
+            node = _merkle_parent(step['hash'], node)
+        else:
+            node = _merkle_parent(node, step['hash'])
+    return node == root
+
+def block_transactions(block):
+    """Return the transactions carried by a block
+
+    Batched blocks hold a list of transactions under a Merkle root, while
+    older blocks hold a single transaction as their data.
+    """
+    data = block['data']
+    if isinstance(data, dict) and 'transactions' in data:
+        return data['transactions']
+    if block['index'] == 0 or not isinstance(data, dict):
+        return []
+    return [data]
+
+def block_is_valid(block):
+    """Check a block's own hash and, for batched blocks, its Merkle root"""
+    # Check hash of current block
+    if block['hash'] != hash_block(block):
+        return False
+
+    # Check the Merkle root of batched blocks
+    data = block['data']
+    if isinstance(data, dict) and 'transactions' in data:
+        leaves = [hash_transaction(tx) for tx in data['transactions']]
+        if not leaves or data.get('merkle_root') != merkle_root(leaves):
+            return False
+
+    return True
+
+def find_broken_link(chain, start=1):
+    """Return the index of the first invalid block from start onwards, or None"""
+    for i in range(max(start, 1), len(chain)):
+        current_block = chain[i]
+        previous_block = chain[i-1]
+
+        if not block_is_valid(current_block):
+            return i
+
+        # Check if previous hash matches
+        if current_block['previous_hash'] != previous_block['hash']:
+            return i
+
+    return None
+
+def write_checkpoint(path, height, tip_hash):
+    """Atomically persist that the chain is valid up to the given height"""
+    checkpoint = {
+        'height': height,
+        'tip_hash': tip_hash,
+        'verified_at': datetime.now().isoformat()
+    }
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+    return checkpoint
+
+class TrustIDIndex:
+    """Persistent tid_hash / phone -> block index lookup
+
+    Entries are appended to an index file as blocks are added, so lookups
+    never have to walk the chain. The file can always be rebuilt from the
+    ledger, and blocks the file is missing are indexed on load. Anchored
+    records such as fines are indexed by their Merkle leaf hash.
+    """
+
+    def __init__(self, path):
+        self.file = LedgerFile(path)
+        self.by_tid = {}
+        self.by_phone = {}
+        self.by_tx = {}
+        # Highest block index covered by the index
+        self.height = 0
+
+        if self.file.exists():
+            for entry in self.file.read_blocks():
+                self._add(entry)
+
+    def _add(self, entry):
+        """Add an index entry to the in-memory maps"""
+        if 'tx_hash' in entry:
+            self.by_tx[entry['tx_hash']] = (entry['block'], entry['tx'])
+        else:
+            self.by_tid[entry['tid_hash']] = (entry['block'], entry.get('tx'))
+            self.by_phone[entry['phone']] = entry['block']
+        self.height = max(self.height, entry['block'])
+
+    @staticmethod
+    def _entries_for_block(block):
+        """Build the index entries for a block"""
+        batched = isinstance(block['data'], dict) and 'transactions' in block['data']
+
+        entries = []
+        for position, tx in enumerate(block_transactions(block)):
+            # Anchored records are looked up by their Merkle leaf
+            if batched and 'type' in tx:
+                entries.append({'tx_hash': hash_transaction(tx), 'block': block['index'], 'tx': position})
+                continue
+            if 'phone' not in tx or 'salt' not in tx:
+                continue
+            entry = {
+                'tid_hash': compute_tid_hash(tx['phone'], tx['timestamp'], tx['salt']),
+                'phone': tx['phone'],
+                'block': block['index']
+            }
+            if batched:
+                entry['tx'] = position
+            entries.append(entry)
+        return entries
+
+    def _has(self, entry):
+        """Check whether an entry is already indexed at its location"""
+        if 'tx_hash' in entry:
+            return self.by_tx.get(entry['tx_hash']) == (entry['block'], entry['tx'])
+        return self.by_tid.get(entry['tid_hash']) == (entry['block'], entry.get('tx'))
+
+    def index_block(self, block, persist=True, missing_only=False):
+        """Index a newly appended block
+
+        With missing_only, entries already in the index are skipped, so a
+        partly indexed block can be completed without duplicating lines.
+        """
+        for entry in self._entries_for_block(block):
+            if missing_only and self._has(entry):
+                continue
+            self._add(entry)
+            if persist:
+                self.file.append(entry)
+        self.height = max(self.height, block['index'])
+
+    def catch_up(self, chain, persist=True):
+        """Index every block beyond the current height
+
+        Returns:
+            bool: False if the index is ahead of chain, which then has to be
+            refreshed from the ledger (or the index rebuilt) by the caller
+        """
+        if self.height >= len(chain):
+            return False
+
+        # A crash between the entries of a batched block leaves it partly
+        # indexed, so the block at the current height is completed first
+        start = self.height
+        self.index_block(chain[start], persist=persist, missing_only=True)
+        for block in chain[start + 1:]:
+            self.index_block(block, persist=persist)
+        return True
+
+    def rebuild(self, chain, persist=True):
+        """Rebuild the whole index from the ledger
+
+        Persisting replaces the index file, so callers sharing it with other
+        processes must hold the ledger lock.
+        """
+        self.by_tid = {}
+        self.by_phone = {}
+        self.by_tx = {}
+        self.height = 0
+
+        entries = []
+        for block in chain:
+            entries.extend(self._entries_for_block(block))
+        for entry in entries:
+            self._add(entry)
+        self.height = len(chain) - 1
+
+        if persist:
+            self.file.write_all(entries)
+        logger.info(f"Rebuilt Trust ID index with {len(entries)} entries")
+
+    def lookup(self, tid_hash):
+        """Return the block index holding a Trust ID, or None"""
+        location = self.by_tid.get(tid_hash)
+        return location[0] if location else None
+
+    def locate(self, tid_hash):
+        """Return the (block index, transaction position) of a Trust ID, or None
+
+        The position is None for single-transaction blocks.
+        """
+        return self.by_tid.get(tid_hash)
+
+    def lookup_phone(self, phone):
+        """Return the block index of the latest Trust ID for a phone, or None"""
+        return self.by_phone.get(phone)
+
+    def locate_record(self, tx_hash):
+        """Return the (block index, transaction position) of an anchored record, or None"""
+        return self.by_tx.get(tx_hash)
+
 class BlockchainVerifier:
     """Simple blockchain for Trust ID verification"""
 
-    def __init__(self):
+    def __init__(self, blockchain_dir=None):
         # Set up storage
-        self.blockchain_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'blockchain')
+        self.blockchain_dir = blockchain_dir or DEFAULT_BLOCKCHAIN_DIR
         if not os.path.exists(self.blockchain_dir):
             os.makedirs(self.blockchain_dir)
 
-        self.blockchain_file = os.path.join(self.blockchain_dir, 'blockchain.json')
+        # Blocks live in an append-only ledger; blockchain.json is the legacy format
+        self.legacy_file = os.path.join(self.blockchain_dir, 'blockchain.json')
+        self.ledger = LedgerFile(os.path.join(self.blockchain_dir, 'ledger.jsonl'))
 
-        # Initialize blockchain if it doesn't exist
-        if not os.path.exists(self.blockchain_file):
-            self._initialize_blockchain()
-        else:
-            # Load existing blockchain
-            with open(self.blockchain_file, 'r') as f:
-                self.chain = json.load(f)
+        # Guards the in-memory chain when the instance is shared between threads
+        self._lock = threading.RLock()
+
+        # Proof of work runs in worker processes, off the request threads
+        self.miner = Miner()
+
+        # Hold the writer lock so concurrent workers never both create or migrate the ledger
+        with self.ledger.locked():
+            if self.ledger.exists():
+                # Load existing blockchain
+                self.chain = self.ledger.read_blocks()
+            elif os.path.exists(self.legacy_file):
+                # One-time migration from the full-file JSON format
+                self.chain = migrate_json_chain(self.legacy_file, self.ledger)
+            else:
+                self.chain = []
+
+            # Initialize blockchain if it doesn't exist
+            if not self.chain:
+                self._initialize_blockchain()
+
+            # Secondary index for constant-time Trust ID lookups, loaded while no
+            # other worker can append, so the chain read above is the whole ledger
+            self.index = TrustIDIndex(os.path.join(self.blockchain_dir, 'trust_index.jsonl'))
+            if not self.index.catch_up(self.chain):
+                # Ahead of the complete ledger, so the index cannot be trusted
+                self.index.rebuild(self.chain)
+
+        # Verification checkpoint: blocks up to this height are known to be valid
+        self.checkpoint_file = os.path.join(self.blockchain_dir, 'checkpoint.json')
+        self.checkpoint = self._load_checkpoint()
 
         logger.info(f"Blockchain initialized with genesis block: {self.chain[0]['hash'][:8]}...")
 
@@ -48,32 +334,46 @@ class BlockchainVerifier:
         self.chain = [genesis_block]
 
         # Save blockchain
-        self._save_blockchain()
+        self._append_block(genesis_block)
 
     def _hash_block(self, block):
         """Create SHA-256 hash of a block"""
-        # Convert block to a consistent string format
-        block_string = json.dumps(
-            {key: block[key] for key in sorted(block.keys()) if key != 'hash'}, 
-            sort_keys=True
-        )
+        return hash_block(block)
+
+    def _append_block(self, block):
+        """Append a single block to the ledger file"""
+        self.ledger.append(block)
 
-        # Return the hash as a hexadecimal string
-        return hashlib.sha256(block_string.encode()).hexdigest()
+    def refresh(self):
+        """Pick up blocks written to the ledger by other processes
 
-    def _save_blockchain(self):
-        """Save blockchain to file"""
-        with open(self.blockchain_file, 'w') as f:
-            json.dump(self.chain, f, indent=2)
+        Only a stat call is made when nothing changed. Appended blocks are
+        read from the last known offset; a rewritten ledger is reloaded.
+        """
+        with self._lock:
+            change = self.ledger.poll()
+            if change == 'appended':
+                new_blocks = self.ledger.read_blocks(self.ledger.offset)
+                self.chain.extend(new_blocks)
+                if new_blocks:
+                    logger.info(f"Loaded {len(new_blocks)} new blocks from {self.ledger.path}")
+            elif change == 'rewritten':
+                self.chain = self.ledger.read_blocks()
+                # The process that rewrote the ledger owns the index file
+                self.index.rebuild(self.chain, persist=False)
+                logger.info(f"Reloaded blockchain with {len(self.chain)} blocks")
+
+            # The writing process already persisted index entries for its blocks
+            if change is not None:
+                self.index.catch_up(self.chain, persist=False)
+            return change is not None
 
     def _get_last_block(self):
         """Get the last block in the chain"""
         return self.chain[-1]
 
-    def _create_block(self, data):
-        """Create a new block with the given data"""
-        last_block = self._get_last_block()
-
+    def _create_block(self, data, last_block):
+        """Create a new block with the given data on top of last_block"""
         new_block = {
             'index': last_block['index'] + 1,
             'timestamp': datetime.now().isoformat(),
@@ -82,63 +382,440 @@ class BlockchainVerifier:
             'nonce': 0
         }
 
-        # Simple proof of work (find a hash with 3 leading zeros)
-        while True:
-            new_block['hash'] = self._hash_block(new_block)
-            if new_block['hash'].startswith('000'):
-                break
-            new_block['nonce'] += 1
+        # Simple proof of work (find a hash with BLOCKCHAIN_DIFFICULTY leading zeros)
+        return self.miner.mine(new_block)
 
-        return new_block
+    def _latest_tip(self):
+        """Catch up with the ledger and return its last block"""
+        with self._lock:
+            self.refresh()
+            return self._get_last_block()
 
-    def add_transaction(self, data):
-        """Add a new transaction to the blockchain"""
-        new_block = self._create_block(data)
-        self.chain.append(new_block)
-        self._save_blockchain()
-        return new_block
-
-    def verify_chain(self):
-        """Verify the integrity of the blockchain"""
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
-
-            # Check hash of current block
-            if current_block['hash'] != self._hash_block(current_block):
+    def _commit_block(self, new_block):
+        """Append a mined block if it still extends the tip; caller holds ledger.locked()"""
+        with self._lock:
+            self.refresh()
+            if self._get_last_block()['hash'] != new_block['previous_hash']:
                 return False
+            self.chain.append(new_block)
+            self._append_block(new_block)
+            self.index.index_block(new_block)
+            return True
+
+    def add_transaction(self, data):
+        """Add a new transaction to the blockchain
+
+        Proof of work runs without holding the chain lock or the ledger lock,
+        so lookups and other writers are never blocked by mining. If another
+        process moved the tip in the meantime the block is mined again; after
+        MINE_RETRIES such races the block is mined under the ledger lock.
+        """
+        for _ in range(MINE_RETRIES):
+            new_block = self._create_block(data, self._latest_tip())
+            with self.ledger.locked():
+                if self._commit_block(new_block):
+                    return new_block
+            logger.info("Ledger tip moved during mining, re-mining block")
+
+        # Keep other writers out until this block is in; readers still only
+        # wait for the short commit
+        with self.ledger.locked():
+            new_block = self._create_block(data, self._latest_tip())
+            self._commit_block(new_block)
+            return new_block
+
+    def add_transactions(self, transactions):
+        """Add a batch of transactions to the blockchain as a single block
+
+        The block carries every transaction under a Merkle root, so the
+        whole batch shares one proof of work and one ledger line.
+        """
+        leaves = [hash_transaction(tx) for tx in transactions]
+        return self.add_transaction({
+            'merkle_root': merkle_root(leaves),
+            'transactions': list(transactions)
+        })
+
+    def get_inclusion_proof(self, block_index, position):
+        """Build the Merkle inclusion proof for a transaction in a batched block"""
+        with self._lock:
+            block = self.chain[block_index]
+            leaves = [hash_transaction(tx) for tx in block_transactions(block)]
+            return {
+                'block_index': block_index,
+                'block_hash': block['hash'],
+                'merkle_root': block['data']['merkle_root'],
+                'leaf': leaves[position],
+                'position': position,
+                'proof': merkle_proof(leaves, position)
+            }
 
-            # Check if previous hash matches
-            if current_block['previous_hash'] != previous_block['hash']:
+    def _load_checkpoint(self):
+        """Load the persisted verification checkpoint"""
+        try:
+            with open(self.checkpoint_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'height': 0, 'tip_hash': self.chain[0]['hash']}
+
+    def _save_checkpoint(self, height):
+        """Persist that the chain is valid up to the given height"""
+        self.checkpoint = write_checkpoint(self.checkpoint_file, height, self.chain[height]['hash'])
+
+    def verify_chain(self, full=False):
+        """Verify the integrity of the blockchain
+
+        By default only blocks after the last checkpoint are re-hashed. The
+        checkpoint is only trusted while the block at its height still
+        carries the recorded hash; otherwise the whole chain is checked.
+        Pass full=True to audit every block from genesis.
+        """
+        with self._lock:
+            start = 1
+            height = self.checkpoint['height']
+            if not full:
+                if height < len(self.chain) and self.chain[height]['hash'] == self.checkpoint['tip_hash']:
+                    start = height + 1
+                else:
+                    logger.warning(f"Verification checkpoint at height {height} does not match the chain")
+
+            broken = find_broken_link(self.chain, start)
+            if broken is not None:
+                logger.error(f"Blockchain verification failed at block {broken}")
                 return False
 
-        return True
+            # Move the checkpoint forward to the verified tip
+            tip = len(self.chain) - 1
+            if tip != height or self.chain[tip]['hash'] != self.checkpoint['tip_hash']:
+                self._save_checkpoint(tip)
+
+            return True
+
+# Process-wide chain shared by all requests
+_shared_blockchain = None
+_shared_blockchain_lock = threading.Lock()
+
+def get_blockchain():
+    """Return the process-wide blockchain, loading the ledger on first use
+
+    The instance stays resident between requests and only re-reads the
+    ledger when another process has changed it.
+    """
+    global _shared_blockchain
+    if _shared_blockchain is None:
+        with _shared_blockchain_lock:
+            if _shared_blockchain is None:
+                _shared_blockchain = BlockchainVerifier()
+    else:
+        _shared_blockchain.refresh()
+    return _shared_blockchain
+
+# Pending transactions are sealed into a block once this many are queued,
+# or once the oldest one has waited this many seconds
+TRUST_ID_BATCH_SIZE = int(os.environ.get("TRUST_ID_BATCH_SIZE", "256"))
+TRUST_ID_BATCH_WAIT = float(os.environ.get("TRUST_ID_BATCH_WAIT", "0.5"))
+
+# A journal holding this many bytes is rewritten with only its unsealed transactions
+MEMPOOL_JOURNAL_COMPACT_BYTES = int(os.environ.get("MEMPOOL_JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+
+def transaction_is_sealed(index, tx):
+    """Check whether a Trust ID or anchored record is already in the ledger"""
+    if 'type' in tx:
+        return index.locate_record(hash_transaction(tx)) is not None
+    return index.lookup(compute_tid_hash(tx['phone'], tx['timestamp'], tx['salt'])) is not None
+
+class TransactionJournal:
+    """Write-ahead log of the transactions queued in one process
+
+    Each transaction is journaled before it is queued and dropped from the
+    journal once its block is sealed. The owning process holds an exclusive
+    lock on the journal for as long as it runs, so a journal whose lock can
+    be taken was left behind by a process that exited or crashed.
+    """
+
+    def __init__(self, journal_dir):
+        os.makedirs(journal_dir, exist_ok=True)
+        self.file = LedgerFile(os.path.join(journal_dir, f"{binascii.hexlify(os.urandom(8)).decode()}.jsonl"))
+        self._owner = _lock_journal(self.file.path, blocking=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._next_id = 0
+
+    def append(self, tx):
+        """Journal a transaction and return its journal ID"""
+        with self._lock:
+            self.file.append(tx)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = tx
+            return entry_id
+
+    def settle(self, entry_ids):
+        """Drop sealed transactions, compacting the file when it allows"""
+        with self._lock:
+            for entry_id in entry_ids:
+                self._entries.pop(entry_id, None)
+            if not self._entries or os.path.getsize(self.file.path) >= MEMPOOL_JOURNAL_COMPACT_BYTES:
+                self.file.write_all(list(self._entries.values()))
+
+def _lock_journal(path, blocking):
+    """Take the owner lock of a journal, or return None if a live process holds it"""
+    handle = open(f"{path}.owner", 'a')
+    if FILE_LOCKING_AVAILABLE:
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            handle.close()
+            return None
+    return handle
+
+def recover_journals(blockchain, journal_dir, exclude=None):
+    """Seal the transactions left in the journals of processes that have exited
+
+    Returns:
+        int: Number of transactions sealed
+    """
+    if not os.path.isdir(journal_dir):
+        return 0
+
+    recovered = 0
+    # Every journal has an owner lock file, even before its first transaction
+    for name in sorted(os.listdir(journal_dir)):
+        path = os.path.join(journal_dir, name[:-len('.owner')])
+        if not name.endswith('.jsonl.owner') or path == exclude:
+            continue
+        owner = _lock_journal(path, blocking=False)
+        if owner is None:
+            continue
+
+        try:
+            transactions = LedgerFile(path).read_blocks() if os.path.exists(path) else []
+            with blockchain.ledger.locked():
+                blockchain.refresh()
+                pending = [tx for tx in transactions if not transaction_is_sealed(blockchain.index, tx)]
+                for i in range(0, len(pending), TRUST_ID_BATCH_SIZE):
+                    blockchain.add_transactions(pending[i:i + TRUST_ID_BATCH_SIZE])
+            if pending:
+                logger.warning(f"Sealed {len(pending)} transactions left unsealed in {path}")
+            recovered += len(pending)
+            if os.path.exists(path):
+                os.remove(path)
+            os.remove(f"{path}.owner")
+        except Exception as e:
+            logger.error(f"Failed to recover transaction journal {path}: {str(e)}")
+        finally:
+            owner.close()
+    return recovered
+
+def anchor_missing_records(transactions):
+    """Seal the given transactions that are not in the ledger yet
+
+    Runs under the ledger lock, so processes starting together anchor each
+    missing record once.
+
+    Returns:
+        int: Number of transactions sealed
+    """
+    blockchain = get_blockchain()
+    with blockchain.ledger.locked():
+        blockchain.refresh()
+        missing = [tx for tx in transactions if not transaction_is_sealed(blockchain.index, tx)]
+        for i in range(0, len(missing), TRUST_ID_BATCH_SIZE):
+            blockchain.add_transactions(missing[i:i + TRUST_ID_BATCH_SIZE])
+    if missing:
+        logger.warning(f"Anchored {len(missing)} records missing from the ledger")
+    return len(missing)
+
+def _anchor_marks_path():
+    return os.path.join(get_blockchain().blockchain_dir, 'anchored.json')
+
+def _read_anchor_marks(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def anchored_up_to(kind):
+    """Highest ID of a kind of record known to be in the ledger, or 0
+
+    Startup checks only need to look at records above it, so their cost
+    does not grow with the number of records ever anchored.
+    """
+    return _read_anchor_marks(_anchor_marks_path()).get(kind, 0)
+
+def mark_anchored_up_to(kind, record_id):
+    """Persist that every record of a kind up to record_id is in the ledger"""
+    path = _anchor_marks_path()
+    with get_blockchain().ledger.locked():
+        marks = _read_anchor_marks(path)
+        if record_id <= marks.get(kind, 0):
+            return
+        marks[kind] = record_id
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(marks, f)
+        os.replace(tmp_path, path)
+
+class TransactionPool:
+    """Mempool that collects pending transactions and seals them into blocks
+
+    A block is sealed as soon as max_size transactions are waiting or the
+    oldest pending transaction has waited max_wait seconds. With a journal
+    directory, queued transactions survive a crash and are sealed by the
+    next process to start; on a normal exit the pool is flushed.
+    """
+
+    def __init__(self, blockchain, max_size=None, max_wait=None, journal_dir=None):
+        self.blockchain = blockchain
+        self.max_size = max_size or TRUST_ID_BATCH_SIZE
+        self.max_wait = TRUST_ID_BATCH_WAIT if max_wait is None else max_wait
+        self.journal = TransactionJournal(journal_dir) if journal_dir else None
+
+        self._pending = []
+        self._oldest = None
+        self._condition = threading.Condition()
+        # Held while a batch is taken and sealed, so flush() never misses one
+        self._seal_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, tx):
+        """Queue a transaction for the next block
+
+        Returns:
+            Future: Resolves to (block, position) once the block is sealed
+        """
+        future = Future()
+        entry_id = self.journal.append(tx) if self.journal else None
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="transaction-pool", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((tx, future, entry_id))
+            self._condition.notify()
+        return future
+
+    def _run(self):
+        """Seal blocks whenever the size or time trigger fires"""
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                while len(self._pending) < self.max_size:
+                    remaining = self._oldest + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+            with self._seal_lock:
+                batch = self._take(self.max_size)
+                if batch:
+                    self._seal(batch)
+
+    def _take(self, count):
+        """Remove up to count pending transactions from the queue"""
+        with self._condition:
+            batch = self._pending[:count]
+            self._pending = self._pending[count:]
+            self._oldest = time.monotonic() if self._pending else None
+            return batch
+
+    def flush(self):
+        """Seal every pending transaction now, e.g. on interpreter exit"""
+        with self._seal_lock:
+            while True:
+                batch = self._take(self.max_size)
+                if not batch:
+                    break
+                self._seal(batch)
+        self.blockchain.ledger.close()
+        self.blockchain.index.file.close()
+
+    def _seal(self, batch):
+        """Write a batch of transactions as one block and resolve their futures
+
+        Transactions of a batch that fails to seal stay in the journal and
+        are sealed again when the next process recovers it.
+        """
+        try:
+            block = self.blockchain.add_transactions([tx for tx, _, _ in batch])
+        except Exception as e:
+            logger.error(f"Failed to seal transaction batch: {str(e)}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        logger.info(f"Sealed block {block['index']} with {len(batch)} transactions")
+        if self.journal:
+            self.journal.settle([entry_id for _, _, entry_id in batch])
+        for position, (_, future, _) in enumerate(batch):
+            future.set_result((block, position))
+
+_shared_pool = None
+
+def get_transaction_pool():
+    """Return the process-wide transaction pool for the resident blockchain
+
+    Journals left by exited processes are sealed when the pool is created.
+    """
+    global _shared_pool
+    blockchain = get_blockchain()
+    if _shared_pool is None:
+        with _shared_blockchain_lock:
+            if _shared_pool is None:
+                journal_dir = os.path.join(blockchain.blockchain_dir, 'mempool')
+                pool = TransactionPool(blockchain, journal_dir=journal_dir)
+                recover_journals(blockchain, journal_dir, exclude=pool.journal.file.path)
+                _shared_pool = pool
+    return _shared_pool
+
+def _new_trust_id_data(phone, aadhaar=""):
+    """Build the transaction recorded on the chain for a new Trust ID"""
+    return {
+        'phone': phone,
+        'aadhaar_hash': hashlib.sha256(aadhaar.encode()).hexdigest() if aadhaar else "",
+        'timestamp': int(time.time()),
+        'salt': binascii.hexlify(os.urandom(8)).decode()
+    }
+
+def create_trust_ids(entries):
+    """Create many Trust IDs at once, e.g. during bulk enrollment drives
+
+    Args:
+        entries (list): (phone, aadhaar) pairs
+
+    Returns:
+        list: (tid_hash, ipfs_cid) per entry, in the same order
+    """
+    pool = get_transaction_pool()
+
+    submitted = []
+    for phone, aadhaar in entries:
+        trust_id_data = _new_trust_id_data(phone, aadhaar)
+        submitted.append((trust_id_data, pool.submit(trust_id_data)))
+
+    results = []
+    for trust_id_data, future in submitted:
+        block, _ = future.result()
+        tid_hash = compute_tid_hash(trust_id_data['phone'], trust_id_data['timestamp'], trust_id_data['salt'])
+        results.append((tid_hash, block['hash'][:16]))
+    return results
 
 def create_trust_id(phone, aadhaar=""):
     """Create a new Trust ID in the blockchain"""
     try:
-        # Initialize blockchain
-        blockchain = BlockchainVerifier()
-
         # Create unique data for this trust ID
-        timestamp = int(time.time())
-        random_salt = binascii.hexlify(os.urandom(8)).decode()
-
-        # Create trust ID data
-        trust_id_data = {
-            'phone': phone,
-            'aadhaar_hash': hashlib.sha256(aadhaar.encode()).hexdigest() if aadhaar else "",
-            'timestamp': timestamp,
-            'salt': random_salt
-        }
+        trust_id_data = _new_trust_id_data(phone, aadhaar)
 
-        # Add to blockchain
-        block = blockchain.add_transaction(trust_id_data)
+        # Queue for the next block; concurrent requests share one block
+        block, _ = get_transaction_pool().submit(trust_id_data).result()
 
         # Create TID hash (simplified)
-        tid_hash = keccak(
-            f"{phone}:{timestamp}:{random_salt}".encode()
-        ).hex()
+        tid_hash = compute_tid_hash(phone, trust_id_data['timestamp'], trust_id_data['salt'])
 
         # In a real implementation, this would be stored on IPFS
         # For demo, we'll return the block hash as the IPFS CID
@@ -149,40 +826,377 @@ def create_trust_id(phone, aadhaar=""):
         logger.error(f"Error creating trust ID: {str(e)}")
         return hashlib.sha256(phone.encode()).hexdigest(), "error"
 
+# Receipts for Trust IDs submitted by this process. The registry is per
+# process; other workers resolve a receipt through the shared ledger, since
+# the receipt ID is the Trust ID hash
+_receipts = OrderedDict()
+_receipts_lock = threading.Lock()
+MAX_RECEIPTS = 10000
+
+def submit_trust_id(phone, aadhaar=""):
+    """Queue a new Trust ID and return a pending receipt straight away
+
+    The Trust ID hash is known before the block is mined. The receipt is
+    marked confirmed, with its block and IPFS CID, once the block holding
+    it has been sealed; use add_receipt_callback to be notified.
+
+    Returns:
+        dict: Receipt with receipt_id, tid_hash and status 'pending'
+    """
+    trust_id_data = _new_trust_id_data(phone, aadhaar)
+    tid_hash = compute_tid_hash(phone, trust_id_data['timestamp'], trust_id_data['salt'])
+    receipt = {
+        'receipt_id': tid_hash,
+        'tid_hash': tid_hash,
+        'phone': phone,
+        'status': 'pending',
+        'submitted_at': datetime.now().isoformat()
+    }
+
+    future = get_transaction_pool().submit(trust_id_data)
+    with _receipts_lock:
+        _receipts[receipt['receipt_id']] = (receipt, future)
+        # Forget the oldest receipts once the registry is full
+        while len(_receipts) > MAX_RECEIPTS:
+            _receipts.popitem(last=False)
+
+    future.add_done_callback(lambda f: _complete_receipt(receipt, f))
+    return dict(receipt)
+
+def _complete_receipt(receipt, future):
+    """Record the outcome of mining on a receipt"""
+    try:
+        block, position = future.result()
+        receipt['block_index'] = block['index']
+        receipt['tx'] = position
+        receipt['ipfs_cid'] = block['hash'][:16]
+        receipt['status'] = 'confirmed'
+    except Exception as e:
+        receipt['error'] = str(e)
+        receipt['status'] = 'failed'
+
+def get_receipt(receipt_id):
+    """Return a copy of a Trust ID receipt, or None if it is unknown
+
+    Receipts submitted through another process are rebuilt from the ledger
+    once their block is sealed; until then they are unknown here.
+    """
+    with _receipts_lock:
+        entry = _receipts.get(receipt_id)
+    if entry:
+        return dict(entry[0])
+
+    blockchain = get_blockchain()
+    location = blockchain.index.locate(receipt_id)
+    if location is None:
+        return None
+    block_index, position = location
+    with blockchain._lock:
+        block = blockchain.chain[block_index]
+    tx = block_transactions(block)[position or 0]
+    return {
+        'receipt_id': receipt_id,
+        'tid_hash': receipt_id,
+        'phone': tx['phone'],
+        'status': 'confirmed',
+        'block_index': block_index,
+        'tx': position,
+        'ipfs_cid': block['hash'][:16]
+    }
+
+def add_receipt_callback(receipt_id, callback):
+    """Call callback(receipt) once the receipt is confirmed or has failed
+
+    If that has already happened the callback runs immediately.
+    """
+    with _receipts_lock:
+        entry = _receipts.get(receipt_id)
+    if entry is None:
+        return False
+
+    receipt, future = entry
+    def notify(f):
+        # Make sure the receipt itself is updated first
+        _complete_receipt(receipt, f)
+        try:
+            callback(dict(receipt))
+        except Exception as e:
+            logger.error(f"Trust ID receipt callback failed: {str(e)}")
+    future.add_done_callback(notify)
+    return True
+
+def get_trust_id_proof(tid_hash):
+    """Return the Merkle inclusion proof for a Trust ID, or None
+
+    Trust IDs stored in single-transaction blocks have no Merkle proof.
+    """
+    blockchain = get_blockchain()
+    location = blockchain.index.locate(tid_hash)
+    if location is None or location[1] is None:
+        return None
+    return blockchain.get_inclusion_proof(*location)
+
+def fine_transaction(fine_id, phone, amount, reason, issued_at):
+    """Build the ledger record that commits to a fine
+
+    The reason is committed by hash so free text stays off the ledger.
+    Recomputing this record from the stored fine and hashing it must give
+    the fine's blockchain reference.
+    """
+    return {
+        'type': 'fine',
+        'fine_id': fine_id,
+        'phone': phone,
+        'amount': float(amount),
+        'reason_hash': hashlib.sha256(reason.encode()).hexdigest(),
+        'issued_at': issued_at.isoformat()
+    }
+
+def fine_reference(tx):
+    """Blockchain reference of a fine record: its 0x-prefixed Merkle leaf hash"""
+    return f"0x{hash_transaction(tx)}"
+
+def anchor_fine(fine_id, phone, amount, reason, issued_at):
+    """Queue a fine for the next batched block without waiting for mining
+
+    Many fines share one block and one proof of work. The returned
+    reference is the 0x-prefixed Merkle leaf hash of the fine record,
+    which resolves to an inclusion proof once the block is sealed.
+
+    Returns:
+        str: Blockchain reference for the fine
+    """
+    tx = fine_transaction(fine_id, phone, amount, reason, issued_at)
+    get_transaction_pool().submit(tx)
+    return fine_reference(tx)
+
+def get_record_proof(reference):
+    """Return the Merkle inclusion proof for an anchored record, or None if still pending"""
+    blockchain = get_blockchain()
+    location = blockchain.index.locate_record(reference[2:] if reference.startswith('0x') else reference)
+    if location is None:
+        return None
+    return blockchain.get_inclusion_proof(*location)
+
+def verify_trust_ids(tid_hashes):
+    """Verify several Trust IDs against the blockchain
+
+    Each hash is resolved through the Trust ID index, so the cost per hash
+    does not depend on the length of the chain.
+
+    Returns:
+        dict: Maps each hash to the index of its block, or None if unknown
+    """
+    # Use the resident blockchain
+    blockchain = get_blockchain()
+
+    # Verify blockchain integrity
+    if not blockchain.verify_chain():
+        logger.error("Blockchain verification failed")
+        return {tid_hash: None for tid_hash in tid_hashes}
+
+    return {tid_hash: blockchain.index.lookup(tid_hash) for tid_hash in tid_hashes}
+
 def verify_trust_id(tid_hash):
     """Verify a Trust ID exists in the blockchain"""
     try:
-        # Initialize blockchain
-        blockchain = BlockchainVerifier()
+        return verify_trust_ids([tid_hash])[tid_hash] is not None
+    except Exception as e:
+        logger.error(f"Error verifying trust ID: {str(e)}")
+        return False
 
-        # Verify blockchain integrity
-        if not blockchain.verify_chain():
-            logger.error("Blockchain verification failed")
-            return False
+def audit_chain(blockchain_dir=None):
+    """Run a full audit of the ledger on disk
+
+    Every block is re-read from the ledger file and re-hashed from genesis,
+    independently of the resident chain and its checkpoint. The audit only
+    reads the ledger and writes the checkpoint; it never touches the index.
+
+    Returns:
+        dict: Audit report with the result, height and first broken block
+    """
+    started = time.monotonic()
+    blockchain_dir = blockchain_dir or DEFAULT_BLOCKCHAIN_DIR
+    ledger_path = os.path.join(blockchain_dir, 'ledger.jsonl')
+    if not os.path.exists(ledger_path):
+        # Creates or migrates the ledger
+        BlockchainVerifier(blockchain_dir)
+
+    chain = LedgerFile(ledger_path).read_blocks()
+    broken = find_broken_link(chain)
+
+    if broken is None and chain:
+        write_checkpoint(os.path.join(blockchain_dir, 'checkpoint.json'), len(chain) - 1, chain[-1]['hash'])
+
+    report = {
+        'valid': broken is None,
+        'height': len(chain) - 1,
+        'first_broken_block': broken,
+        'elapsed_seconds': round(time.monotonic() - started, 3)
+    }
+    logger.info(f"Blockchain audit finished: {report}")
+    return report
+
+def _audit_range(ledger_path, start, end):
+    """Verify the blocks whose ledger lines start in [start, end)
 
-        # Search for the TID hash in the blockchain
-        for block in blockchain.chain:
-            if block['index'] == 0:  # Skip genesis block
+    Runs in a worker process. Links inside the range are checked here;
+    the caller checks the links between neighbouring ranges using the
+    first previous_hash and last hash reported for each range.
+    """
+    summary = {'first_index': None, 'first_previous_hash': None, 'last_hash': None,
+               'blocks': 0, 'broken': None}
+
+    with open(ledger_path, 'rb') as f:
+        # Skip the line that straddles the start of the range
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != b'\n':
+                f.readline()
+
+        previous_hash = None
+        while f.tell() < end:
+            line = f.readline()
+            # Ignore an append still in progress at the tip
+            if not line.endswith(b'\n'):
+                break
+            if not line.strip():
                 continue
 
-            # Extract data from block
-            data = block['data']
+            block = json.loads(line)
+            if summary['first_index'] is None:
+                summary['first_index'] = block['index']
+                summary['first_previous_hash'] = block['previous_hash']
+            summary['blocks'] += 1
 
-            # Check if this block contains the TID
-            if isinstance(data, dict) and 'phone' in data:
-                # Recreate the TID hash
-                phone = data['phone']
-                timestamp = data['timestamp']
-                salt = data['salt']
+            if summary['broken'] is None and block['index'] != 0:
+                linked = previous_hash is None or block['previous_hash'] == previous_hash
+                if not linked or not block_is_valid(block):
+                    summary['broken'] = block['index']
 
-                calculated_hash = keccak(
-                    f"{phone}:{timestamp}:{salt}".encode()
-                ).hex()
+            previous_hash = block['hash']
 
-                if calculated_hash == tid_hash:
-                    return True
+        summary['last_hash'] = previous_hash
+    return summary
 
-        return False
-    except Exception as e:
-        logger.error(f"Error verifying trust ID: {str(e)}")
-        return False
\ No newline at end of file
+def audit_chain_parallel(blockchain_dir=None, workers=None, progress=None):
+    """Run a full audit of the ledger spread across worker processes
+
+    The ledger is split into byte ranges that are verified independently;
+    links between ranges are checked once all results are in.
+
+    Args:
+        blockchain_dir (str, optional): Blockchain directory
+        workers (int, optional): Worker processes, defaults to the CPU count
+        progress (callable, optional): Called with (blocks_done, bytes_done, total_bytes)
+
+    Returns:
+        dict: Audit report with the result, height, first broken block and throughput
+    """
+    started = time.monotonic()
+    blockchain_dir = blockchain_dir or DEFAULT_BLOCKCHAIN_DIR
+    ledger_path = os.path.join(blockchain_dir, 'ledger.jsonl')
+    if not os.path.exists(ledger_path):
+        # Creates or migrates the ledger
+        BlockchainVerifier(blockchain_dir)
+
+    workers = workers or os.cpu_count() or 1
+    total_bytes = os.path.getsize(ledger_path)
+
+    # Several ranges per worker keep the pool busy and progress reports frequent
+    range_count = max(1, min(workers * 8, total_bytes // (256 * 1024) or 1))
+    bounds = [total_bytes * i // range_count for i in range(range_count + 1)]
+
+    results = [None] * range_count
+    blocks_done = 0
+    bytes_done = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {
+            executor.submit(_audit_range, ledger_path, bounds[i], bounds[i + 1]): i
+            for i in range(range_count)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            blocks_done += results[i]['blocks']
+            bytes_done += bounds[i + 1] - bounds[i]
+            if progress:
+                progress(blocks_done, bytes_done, total_bytes)
+            else:
+                logger.info(f"Audit progress: {blocks_done} blocks, {100 * bytes_done // max(total_bytes, 1)}%")
+
+    # Stitch the ranges together and find the first broken link
+    broken = None
+    previous_hash = None
+    expected_index = 0
+    height = -1
+    for summary in results:
+        if summary['blocks'] == 0:
+            continue
+        if broken is None:
+            if summary['first_index'] != expected_index:
+                broken = expected_index
+            elif previous_hash is not None and summary['first_previous_hash'] != previous_hash:
+                broken = summary['first_index']
+            elif summary['broken'] is not None:
+                broken = summary['broken']
+        expected_index = summary['first_index'] + summary['blocks']
+        previous_hash = summary['last_hash']
+        height = expected_index - 1
+
+    if broken is None and height >= 0:
+        write_checkpoint(os.path.join(blockchain_dir, 'checkpoint.json'), height, previous_hash)
+
+    elapsed = time.monotonic() - started
+    report = {
+        'valid': broken is None,
+        'height': height,
+        'first_broken_block': broken,
+        'workers': workers,
+        'elapsed_seconds': round(elapsed, 3),
+        'blocks_per_second': round(blocks_done / elapsed, 1) if elapsed else None,
+        'megabytes_per_second': round(total_bytes / elapsed / 1e6, 2) if elapsed else None
+    }
+    logger.info(f"Parallel blockchain audit finished: {report}")
+    return report
+
+def start_background_audit(interval, blockchain_dir=None):
+    """Run a full audit on a daemon thread every interval seconds"""
+    def run():
+        while True:
+            try:
+                audit_chain(blockchain_dir)
+            except Exception as e:
+                logger.error(f"Background blockchain audit failed: {str(e)}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="blockchain-audit", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="RailGuard Trust ID blockchain tools")
+    parser.add_argument("--dir", help="Blockchain directory (defaults to ./blockchain)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    audit_parser = subparsers.add_parser("audit", help="Re-verify every block from genesis")
+    audit_parser.add_argument("--parallel", action="store_true", help="Split the audit across CPU cores")
+    audit_parser.add_argument("--workers", type=int, help="Worker processes for --parallel")
+    subparsers.add_parser("rebuild-index", help="Rebuild the Trust ID index from the ledger")
+    args = parser.parse_args()
+
+    if args.command == "audit":
+        if args.parallel:
+            report = audit_chain_parallel(args.dir, workers=args.workers)
+        else:
+            report = audit_chain(args.dir)
+        print(json.dumps(report, indent=2))
+        raise SystemExit(0 if report['valid'] else 1)
+    elif args.command == "rebuild-index":
+        blockchain = BlockchainVerifier(args.dir)
+        with blockchain.ledger.locked():
+            blockchain.refresh()
+            blockchain.index.rebuild(blockchain.chain)
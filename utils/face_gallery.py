@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from utils.file_lock import FileLock
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Size of the normalized face crops kept in the gallery
+FACE_SIZE = 200
+
+# Gallery rows converted to float per batched scoring step
+GALLERY_BATCH_ROWS = int(os.environ.get("FACE_GALLERY_BATCH_ROWS", "64"))
+
+# SSIM parameters matching skimage.metrics.structural_similarity defaults for uint8 images
+SSIM_WIN_SIZE = 7
+SSIM_DATA_RANGE = 255.0
+SSIM_C1 = (0.01 * SSIM_DATA_RANGE) ** 2
+SSIM_C2 = (0.03 * SSIM_DATA_RANGE) ** 2
+
+
+def box_mean(images):
+    """Mean of every full SSIM window in a batch of images
+
+    Uses summed-area tables, so the cost does not depend on the window
+    size. Only windows that lie entirely inside the image are returned;
+    these are exactly the windows skimage keeps after cropping its border.
+    """
+    win = SSIM_WIN_SIZE
+    table = np.zeros(images.shape[:-2] + (images.shape[-2] + 1, images.shape[-1] + 1))
+    np.cumsum(images, axis=-2, out=table[..., 1:, 1:])
+    np.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    sums = table[..., win:, win:] - table[..., :-win, win:] - table[..., win:, :-win] + table[..., :-win, :-win]
+    return sums / (win * win)
+
+
+class FaceGallery:
+    """Every registered face crop in one memory-mapped array
+
+    Crops are stored as rows of a uint8 ``crops.npy`` of shape
+    (capacity, 200, 200) with a per-face mean and variance alongside, so a
+    probe face can be scored against the whole gallery in a few batched
+    NumPy operations instead of one comparison per registered user.
+    """
+
+    def __init__(self, gallery_dir):
+        self.gallery_dir = gallery_dir
+        os.makedirs(gallery_dir, exist_ok=True)
+        self.crops_path = os.path.join(gallery_dir, 'crops.npy')
+        self.stats_path = os.path.join(gallery_dir, 'stats.npy')
+        self.index_path = os.path.join(gallery_dir, 'index.json')
+
+        # Writers in every process serialize on a lock file next to the gallery
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(gallery_dir, 'gallery.lock'))
+        self._crops = None
+        self._stats = np.zeros((0, 2))
+        self.phones = []
+        self.rows = {}
+        self._index_mtime_ns = None
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self.phones)
+
+    def __contains__(self, phone):
+        return phone in self.rows
+
+    def refresh(self):
+        """Reload the gallery if another process changed it"""
+        with self._lock:
+            try:
+                mtime_ns = os.stat(self.index_path).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if mtime_ns == self._index_mtime_ns:
+                return
+
+            # Never read the index, stats and crops halfway through another process's write
+            with self._file_lock.locked():
+                try:
+                    mtime_ns = os.stat(self.index_path).st_mtime_ns
+                    with open(self.index_path, 'r') as f:
+                        phones = json.load(f)['phones']
+                    crops = np.load(self.crops_path, mmap_mode='r+')
+                    stats = np.load(self.stats_path)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.error(f"Failed to load face gallery from {self.gallery_dir}: {str(e)}")
+                    return
+
+            self._crops = crops
+            self._stats = stats[:len(phones)]
+            self.phones = phones
+            self.rows = {phone: row for row, phone in enumerate(phones)}
+            self._index_mtime_ns = mtime_ns
+            logger.info(f"Loaded face gallery with {len(phones)} faces from {self.gallery_dir}")
+
+    def _ensure_capacity(self, rows):
+        """Grow the memory-mapped crop file to hold at least the given rows"""
+        capacity = 0 if self._crops is None else self._crops.shape[0]
+        if rows <= capacity:
+            return
+
+        new_capacity = max(rows, capacity * 2, 64)
+        tmp_path = f"{self.crops_path}.tmp"
+        grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                          shape=(new_capacity, FACE_SIZE, FACE_SIZE))
+        if capacity:
+            grown[:len(self.phones)] = self._crops[:len(self.phones)]
+        grown.flush()
+        del grown
+        os.replace(tmp_path, self.crops_path)
+        self._crops = np.load(self.crops_path, mmap_mode='r+')
+
+    def _write_json_atomic(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def add(self, phone, face_gray):
+        """Store or replace the face crop for a phone number"""
+        self.add_many({phone: face_gray})
+
+    def add_many(self, faces):
+        """Store or replace the face crops for many phone numbers in one pass
+
+        Crop rows are written first and the index last, so a crash never
+        leaves the index pointing at a missing face. The whole update holds
+        the gallery lock file, so workers never hand out the same row.
+
+        Args:
+            faces: dict of phone -> 200x200 uint8 grayscale crop
+        """
+        crops = {}
+        for phone, face_gray in faces.items():
+            face = np.asarray(face_gray, dtype=np.uint8)
+            if face.shape != (FACE_SIZE, FACE_SIZE):
+                raise ValueError(f"Face crop must be {FACE_SIZE}x{FACE_SIZE}, got {face.shape}")
+            crops[phone] = face
+        if not crops:
+            return
+
+        with self._lock, self._file_lock.locked():
+            self.refresh()
+            new_phones = [phone for phone in crops if phone not in self.rows]
+            self._ensure_capacity(len(self.phones) + len(new_phones))
+
+            if new_phones:
+                self._stats = np.vstack([self._stats, np.zeros((len(new_phones), 2))])
+                self.phones = self.phones + new_phones
+                self.rows.update({phone: row for row, phone in enumerate(self.phones) if phone in crops})
+
+            for phone, face in crops.items():
+                row = self.rows[phone]
+                self._crops[row] = face
+                face_float = face.astype(np.float64)
+                self._stats[row] = (face_float.mean(), face_float.var())
+            self._crops.flush()
+
+            tmp_path = f"{self.stats_path}.tmp.npy"
+            np.save(tmp_path, self._stats)
+            os.replace(tmp_path, self.stats_path)
+            self._write_json_atomic(self.index_path, {'face_size': FACE_SIZE, 'phones': self.phones})
+            self._index_mtime_ns = os.stat(self.index_path).st_mtime_ns
+
+    def get(self, phone):
+        """Return a copy of the stored face crop for a phone number, or None"""
+        with self._lock:
+            self.refresh()
+            row = self.rows.get(phone)
+            return None if row is None else np.array(self._crops[row])
+
+    def score(self, probe_gray, phones=None):
+        """Score a probe crop against stored faces
+
+        SSIM matches skimage.metrics.structural_similarity with its default
+        7x7 uniform window and sample covariance. MSE is computed in floating
+        point from the precomputed per-face statistics.
+
+        Args:
+            probe_gray: 200x200 uint8 grayscale face crop
+            phones: Only score these phone numbers (default: the whole gallery)
+
+        Returns:
+            dict: phone -> {'ssim': float, 'mse': float}
+        """
+        probe = np.asarray(probe_gray, dtype=np.float64)
+        if probe.shape != (FACE_SIZE, FACE_SIZE):
+            raise ValueError(f"Probe must be {FACE_SIZE}x{FACE_SIZE}, got {probe.shape}")
+
+        with self._lock:
+            self.refresh()
+            if phones is None:
+                selected = list(self.phones)
+            else:
+                selected = [phone for phone in phones if phone in self.rows]
+            if not selected:
+                return {}
+            rows = np.array([self.rows[phone] for phone in selected])
+            crops = self._crops
+            stats = self._stats[rows]
+
+        pixels = FACE_SIZE * FACE_SIZE
+        probe_flat = probe.reshape(-1)
+        probe_sq_sum = probe_flat @ probe_flat
+
+        # Window statistics of the probe are shared by every comparison
+        cov_norm = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
+        uy = box_mean(probe)
+        vy = cov_norm * (box_mean(probe * probe) - uy * uy)
+
+        ssim = np.empty(len(rows))
+        cross = np.empty(len(rows))
+        for start in range(0, len(rows), GALLERY_BATCH_ROWS):
+            batch_rows = rows[start:start + GALLERY_BATCH_ROWS]
+            # Only the selected rows are copied out of the memory map
+            batch = crops[batch_rows].astype(np.float64)
+
+            cross[start:start + len(batch_rows)] = batch.reshape(len(batch_rows), -1) @ probe_flat
+
+            ux = box_mean(batch)
+            vx = cov_norm * (box_mean(batch * batch) - ux * ux)
+            vxy = cov_norm * (box_mean(batch * probe) - ux * uy)
+
+            s = ((2 * ux * uy + SSIM_C1) * (2 * vxy + SSIM_C2) /
+                 ((ux * ux + uy * uy + SSIM_C1) * (vx + vy + SSIM_C2)))
+            ssim[start:start + len(batch_rows)] = s.mean(axis=(1, 2))
+
+        # sum((x - y)^2) = sum(x^2) - 2 sum(xy) + sum(y^2), with sum(x^2) = N (var + mean^2)
+        gallery_sq_sum = pixels * (stats[:, 1] + stats[:, 0] ** 2)
+        mse = np.maximum(gallery_sq_sum - 2 * cross + probe_sq_sum, 0) / pixels
+
+        return {phone: {'ssim': float(ssim[i]), 'mse': float(mse[i])} for i, phone in enumerate(selected)}
@@ -0,0 +1,337 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.file_lock import FileLock
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# OpenCV's default LBPH: 8 neighbours (256 patterns) in an 8x8 grid of cells
+LBPH_HISTOGRAM_SIZE = 8 * 8 * 256
+LBPH_HISTOGRAM_BYTES = LBPH_HISTOGRAM_SIZE * 4
+
+# Histogram rows compared per NumPy step, and retired rows tolerated before compaction
+LBPH_BATCH_ROWS = int(os.environ.get("LBPH_BATCH_ROWS", "512"))
+LBPH_COMPACT_MIN_ROWS = int(os.environ.get("LBPH_COMPACT_MIN_ROWS", "1024"))
+
+
+def create_lbph_recognizer():
+    """Create a new LBPH face recognizer"""
+    try:
+        return cv2.face_LBPHFaceRecognizer.create()
+    except (AttributeError, cv2.error):
+        return cv2.face.LBPHFaceRecognizer_create()
+
+
+def lbph_available():
+    """Check whether this OpenCV build includes the LBPH recognizer (opencv-contrib)"""
+    try:
+        create_lbph_recognizer()
+        return True
+    except (AttributeError, cv2.error):
+        return False
+
+
+def augment_face(base_face):
+    """Build LBPH training samples from one normalized 200x200 face
+
+    Adds slightly rotated, scaled and brightness-adjusted copies of the face
+    for more robust recognition.
+    """
+    samples = [base_face]
+
+    # Add slightly rotated versions
+    rows, cols = base_face.shape
+    center = (cols // 2, rows // 2)
+    for angle in [-15, -10, -5, 5, 10, 15]:
+        rotation_matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+        samples.append(cv2.warpAffine(base_face, rotation_matrix, (cols, rows)))
+
+    # Also add slightly scaled versions
+    for scale in [0.9, 0.95, 1.05, 1.1]:
+        scaled_size = (int(cols * scale), int(rows * scale))
+        scaled = cv2.resize(base_face, scaled_size)
+        # Make sure it's the right size again
+        if scale < 1.0:
+            # Pad if smaller
+            pad_h = (200 - scaled.shape[0]) // 2
+            pad_w = (200 - scaled.shape[1]) // 2
+            samples.append(cv2.copyMakeBorder(scaled, pad_h, pad_h, pad_w, pad_w,
+                                              cv2.BORDER_CONSTANT, value=0))
+        else:
+            # Crop if larger
+            start_h = (scaled.shape[0] - 200) // 2
+            start_w = (scaled.shape[1] - 200) // 2
+            samples.append(scaled[start_h:start_h + 200, start_w:start_w + 200])
+
+    # Add brightness variations
+    for alpha in [0.8, 1.2]:  # Darker and lighter versions
+        samples.append(cv2.convertScaleAbs(base_face, alpha=alpha, beta=0))
+
+    return samples
+
+
+def lbph_histograms(samples):
+    """Spatial LBP histograms of face samples, exactly as OpenCV's LBPH computes them
+
+    Returns:
+        ndarray: float32 array of shape (len(samples), LBPH_HISTOGRAM_SIZE)
+    """
+    model = create_lbph_recognizer()
+    model.train(list(samples), np.zeros(len(samples), dtype=np.int32))
+    histograms = np.vstack([h.reshape(-1) for h in model.getHistograms()]).astype(np.float32)
+    if histograms.shape[1] != LBPH_HISTOGRAM_SIZE:
+        raise ValueError(f"Unexpected LBPH histogram size {histograms.shape[1]}")
+    return histograms
+
+
+def chi_square_distances(histograms, query):
+    """Chi-square distance from a query histogram to each row, as LBPH predict() measures it"""
+    difference = histograms - query
+    total = histograms + query
+    # Bins empty in both histograms have a zero difference, so a tiny
+    # denominator keeps them at zero without a masked divide
+    total += np.float32(1e-30)
+    np.multiply(difference, difference, out=difference)
+    np.divide(difference, total, out=difference)
+    return 2 * difference.sum(axis=1, dtype=np.float64)
+
+
+class GalleryRecognizer:
+    """LBPH face recognition over the histograms of every enrolled sample
+
+    The spatial LBP histogram of each training sample is appended to a raw
+    float32 file and each enrollment appends one line naming the phone's
+    rows to a label file, so enrolling costs the same however large the
+    gallery is. Distances are the same chi-square LBPH uses, computed with
+    NumPy over a read-only memory map: 1:1 verification reads only the
+    claimed phone's rows and 1:N scans every current identity in chunks.
+
+    Re-enrolling a phone points it at new rows; the retired rows are
+    dropped by compacting the files once they outnumber the current ones.
+    """
+
+    def __init__(self, models_dir):
+        self.models_dir = models_dir
+        self.histograms_path = os.path.join(models_dir, 'gallery_lbph.f32')
+        self.labels_path = os.path.join(models_dir, 'gallery_lbph_labels.jsonl')
+
+        # Writers in every process serialize on a lock file next to the model
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(models_dir, 'gallery_lbph.lock'))
+
+        # phone -> (first row, row count) of its current samples
+        self.identities = {}
+        self.rows = 0
+        self._histograms = None
+        self._labels_offset = 0
+        self._labels_inode = None
+
+    @contextmanager
+    def locked(self):
+        """Keep every process from changing the model for the duration of the with block"""
+        with self._lock, self._file_lock.locked():
+            yield
+
+    def exists(self):
+        """Check whether the gallery model has been saved"""
+        return os.path.exists(self.labels_path) and os.path.exists(self.histograms_path)
+
+    def refresh(self):
+        """Pick up enrollments written by this or another process"""
+        with self._lock:
+            try:
+                st = os.stat(self.labels_path)
+            except FileNotFoundError:
+                return
+            if st.st_ino == self._labels_inode and st.st_size == self._labels_offset:
+                return
+
+            with self._file_lock.locked():
+                self._load_labels()
+
+    def _load_labels(self):
+        """Read label lines appended since the last refresh; caller holds both locks"""
+        st = os.stat(self.labels_path)
+        if st.st_ino != self._labels_inode or st.st_size < self._labels_offset:
+            # Rewritten by a compaction or retrain, read it again from the start
+            self.identities = {}
+            self.rows = 0
+            self._histograms = None
+            self._labels_offset = 0
+            self._labels_inode = st.st_ino
+
+        with open(self.labels_path, 'rb') as f:
+            f.seek(self._labels_offset)
+            content = f.read()
+        # An incomplete last line is a write still in progress
+        end = content.rfind(b'\n') + 1
+        for line in content[:end].splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                self.identities[entry['phone']] = (entry['start'], entry['count'])
+                self.rows = max(self.rows, entry['start'] + entry['count'])
+        self._labels_offset += end
+
+        if self.rows == 0:
+            self._histograms = None
+        elif self._histograms is None or self._histograms.shape[0] != self.rows:
+            self._histograms = np.memmap(self.histograms_path, dtype=np.float32, mode='r',
+                                         shape=(self.rows, LBPH_HISTOGRAM_SIZE))
+
+    def _append(self, faces):
+        """Append histograms and label lines; caller holds both locks"""
+        histograms = lbph_histograms([sample for samples in faces.values() for sample in samples])
+
+        # Histogram rows past the last label line belong to an interrupted write
+        with open(self.histograms_path, 'ab') as f:
+            f.truncate(self.rows * LBPH_HISTOGRAM_BYTES)
+            f.write(histograms.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        # The label lines are written last and mark the rows as committed
+        lines = []
+        start = self.rows
+        for phone, samples in faces.items():
+            if phone in self.identities:
+                logger.info(f"Re-enrolling {phone}, retiring {self.identities[phone][1]} samples")
+            lines.append(json.dumps({'phone': phone, 'start': start, 'count': len(samples)}) + '\n')
+            start += len(samples)
+        with open(self.labels_path, 'a') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self._load_labels()
+
+    def enroll(self, phone, samples):
+        """Add a phone number's training samples to the model"""
+        self.enroll_many({phone: samples})
+
+    def enroll_many(self, faces):
+        """Add training samples for many phone numbers in one append
+
+        Args:
+            faces: dict of phone -> list of training samples
+        """
+        faces = {phone: samples for phone, samples in faces.items() if len(samples)}
+        if not faces:
+            return
+
+        with self._lock, self._file_lock.locked():
+            if self.exists():
+                self._load_labels()
+            self._append(faces)
+
+            current = sum(count for _, count in self.identities.values())
+            if self.rows - current > max(current, LBPH_COMPACT_MIN_ROWS):
+                self._compact()
+        logger.info(f"Enrolled {len(faces)} identities in the gallery face model")
+
+    def _write_all(self, histograms, identities):
+        """Replace both files with the given rows; caller holds both locks"""
+        tmp_histograms_path = f"{self.histograms_path}.tmp"
+        with open(tmp_histograms_path, 'wb') as f:
+            for chunk in histograms:
+                f.write(np.ascontiguousarray(chunk, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_histograms_path, self.histograms_path)
+
+        tmp_labels_path = f"{self.labels_path}.tmp"
+        with open(tmp_labels_path, 'w') as f:
+            for phone, (start, count) in identities.items():
+                f.write(json.dumps({'phone': phone, 'start': start, 'count': count}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_labels_path, self.labels_path)
+
+        self._labels_inode = None
+        self._load_labels()
+
+    def _compact(self):
+        """Drop the rows of retired enrollments; caller holds both locks"""
+        chunks, identities, start = [], {}, 0
+        for phone, (first, count) in self.identities.items():
+            chunks.append(np.array(self._histograms[first:first + count]))
+            identities[phone] = (start, count)
+            start += count
+        retired = self.rows - start
+        self._write_all(chunks, identities)
+        logger.info(f"Compacted gallery face model, dropped {retired} retired samples")
+
+    def retrain(self, faces):
+        """Rebuild the model from scratch
+
+        Args:
+            faces: dict of phone -> list of training samples
+        """
+        with self._lock, self._file_lock.locked():
+            chunks, identities, start = [], {}, 0
+            for phone, samples in faces.items():
+                if not len(samples):
+                    continue
+                chunks.append(lbph_histograms(samples))
+                identities[phone] = (start, len(samples))
+                start += len(samples)
+            if not chunks:
+                return
+            self._write_all(chunks, identities)
+        logger.info(f"Retrained gallery face model with {len(identities)} identities")
+
+    def distances(self, face_gray, phones=None):
+        """LBPH distance from a face to enrolled phone numbers
+
+        Args:
+            face_gray: Normalized 200x200 grayscale face
+            phones: Only these phone numbers (default: every enrolled one)
+
+        Returns:
+            dict: phone -> closest sample distance (lower is closer)
+        """
+        self.refresh()
+        with self._lock:
+            histograms = self._histograms
+            if histograms is None:
+                return {}
+            if phones is None:
+                selected = list(self.identities.items())
+            else:
+                selected = [(phone, self.identities[phone]) for phone in phones if phone in self.identities]
+        if not selected:
+            return {}
+
+        query = lbph_histograms([face_gray])[0]
+        if phones is None:
+            # A full scan reads contiguous slices of the memory map, retired rows included
+            scores = np.empty(len(histograms))
+            for start in range(0, len(histograms), LBPH_BATCH_ROWS):
+                scores[start:start + LBPH_BATCH_ROWS] = chi_square_distances(
+                    histograms[start:start + LBPH_BATCH_ROWS], query)
+            return {phone: float(scores[start:start + count].min()) for phone, (start, count) in selected}
+
+        # Only the claimed identities' rows are read
+        return {phone: float(chi_square_distances(histograms[start:start + count], query).min())
+                for phone, (start, count) in selected}
+
+    def stats(self):
+        """Return identity and sample counts of the model"""
+        self.refresh()
+        with self._lock:
+            current = sum(count for _, count in self.identities.values())
+            return {
+                'identities': len(self.identities),
+                'samples': current,
+                'retired_samples': self.rows - current,
+                'bytes': self.rows * LBPH_HISTOGRAM_BYTES
+            }
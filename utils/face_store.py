@@ -0,0 +1,188 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Per-user image files of the flat faces/ layout, by image kind
+LEGACY_IMAGE_FILES = {
+    'original': '{phone}.jpg',
+    'face': '{phone}_face.jpg',
+    'face_gray': '{phone}_face_gray.jpg'
+}
+
+
+class FaceStore:
+    """Registered faces in a single SQLite database
+
+    The faces table is the manifest: one row of JSON metadata per phone
+    number. Encoded images (the original upload, the color face crop and the
+    equalized grayscale crop) are packed into face_images, so listing and
+    loading users never touch the image data or scan a directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS faces ("
+                "phone TEXT PRIMARY KEY, metadata TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS face_images ("
+                "phone TEXT NOT NULL, kind TEXT NOT NULL, data BLOB NOT NULL, "
+                "PRIMARY KEY (phone, kind))"
+            )
+
+        # Cached phone list, valid while no connection has committed a change
+        self._phones = None
+        self._data_version = None
+        # Writes through this connection, which data_version does not count
+        self._local_writes = 0
+
+    def _changed(self):
+        """Invalidate the cached phone list after a write through this connection"""
+        self._phones = None
+        self._local_writes += 1
+
+    def version(self):
+        """Token that changes whenever any connection commits a write"""
+        with self._lock:
+            return (self._conn.execute("PRAGMA data_version").fetchone()[0], self._local_writes)
+
+    def phones(self):
+        """List every registered phone number"""
+        with self._lock:
+            # data_version only moves when another connection commits
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._phones is None or version != self._data_version:
+                self._phones = [row[0] for row in self._conn.execute("SELECT phone FROM faces ORDER BY phone")]
+                self._data_version = version
+            return list(self._phones)
+
+    def __len__(self):
+        return len(self.phones())
+
+    def get_metadata(self, phone):
+        """Return the metadata for a phone number, or None if not registered"""
+        record = self.get_record(phone)
+        return None if record is None else record[0]
+
+    def get_record(self, phone):
+        """Return (metadata, updated_at) for a phone number, or None if not registered"""
+        with self._lock:
+            row = self._conn.execute("SELECT metadata, updated_at FROM faces WHERE phone = ?", (phone,)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def updated_at(self, phone):
+        """Return when the metadata of a phone number was last written, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT updated_at FROM faces WHERE phone = ?", (phone,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_metadata(self, phone, metadata):
+        """Create or replace the metadata for a phone number"""
+        self.put_many([(phone, metadata, {})])
+
+    def get_image(self, phone, kind):
+        """Return the encoded image of the given kind for a phone number, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM face_images WHERE phone = ? AND kind = ?", (phone, kind)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def put_images(self, phone, images):
+        """Store encoded images for a phone number, by kind"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO face_images (phone, kind, data) VALUES (?, ?, ?)",
+                [(phone, kind, data) for kind, data in images.items()]
+            )
+            self._changed()
+
+    def put_many(self, records):
+        """Store many registrations in one transaction
+
+        Args:
+            records: (phone, metadata, images) tuples; metadata may be None
+                to leave it unchanged and images is a dict of kind -> bytes
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            for phone, metadata, images in records:
+                if metadata is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO faces (phone, metadata, updated_at) VALUES (?, ?, ?)",
+                        (phone, json.dumps(metadata), now)
+                    )
+                if images:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO face_images (phone, kind, data) VALUES (?, ?, ?)",
+                        [(phone, kind, data) for kind, data in images.items()]
+                    )
+            self._changed()
+
+    def stats(self):
+        """Return the number of registrations and the database size"""
+        return {'faces': len(self), 'bytes': os.path.getsize(self.path)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_flat_layout(faces_dir, store):
+    """Move registrations from the flat faces/ directory into the store
+
+    Every <phone>.json and its image files are copied into the store in one
+    transaction, then moved to faces/migrated/ so they are never read again.
+
+    Returns:
+        int: Number of registrations migrated
+    """
+    records = []
+    migrated_files = []
+    for json_path in sorted(glob.glob(os.path.join(faces_dir, "*.json"))):
+        phone = os.path.basename(json_path)[:-len(".json")]
+        # Only phone number registrations (all digits)
+        if not phone.isdigit():
+            continue
+
+        try:
+            with open(json_path, 'r') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Skipping unreadable face registration {json_path}: {str(e)}")
+            continue
+
+        images = {}
+        migrated_files.append(json_path)
+        for kind, pattern in LEGACY_IMAGE_FILES.items():
+            image_path = os.path.join(faces_dir, pattern.format(phone=phone))
+            if os.path.exists(image_path):
+                with open(image_path, 'rb') as f:
+                    images[kind] = f.read()
+                migrated_files.append(image_path)
+        records.append((phone, metadata, images))
+
+    if not records:
+        return 0
+
+    store.put_many(records)
+
+    migrated_dir = os.path.join(faces_dir, 'migrated')
+    os.makedirs(migrated_dir, exist_ok=True)
+    for path in migrated_files:
+        os.replace(path, os.path.join(migrated_dir, os.path.basename(path)))
+
+    logger.info(f"Migrated {len(records)} face registrations from {faces_dir} to {store.path}")
+    return len(records)
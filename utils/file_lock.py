@@ -0,0 +1,59 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# Advisory file locks are only available on POSIX systems
+try:
+    import fcntl
+    FILE_LOCKING_AVAILABLE = True
+except ImportError:
+    FILE_LOCKING_AVAILABLE = False
+
+
+class FileLock:
+    """Exclusive lock shared by every process that opens the same lock file
+
+    Works like LedgerFile.locked(): the lock is re-entrant within a
+    process, and without fcntl it only serializes threads of this process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._handle = None
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock for the duration of the with block"""
+        with self._thread_lock:
+            if self._depth == 0 and FILE_LOCKING_AVAILABLE:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._handle = open(self.path, 'a')
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and self._handle is not None:
+                    fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+                    self._handle.close()
+                    self._handle = None
+
+
+def hold_lock(path, blocking=True):
+    """Take an exclusive lock on a file and keep it until the handle is closed
+
+    Returns:
+        The open lock file, or None if another process holds the lock and
+        blocking is False
+    """
+    handle = open(path, 'a')
+    if FILE_LOCKING_AVAILABLE:
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            handle.close()
+            return None
+    return handle
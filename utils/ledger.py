@@ -0,0 +1,234 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Advisory file locks are only available on POSIX systems
+try:
+    import fcntl
+    FILE_LOCKING_AVAILABLE = True
+except ImportError:
+    FILE_LOCKING_AVAILABLE = False
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+if not FILE_LOCKING_AVAILABLE:
+    logger.warning("fcntl not available, ledger writes are only safe within a single process")
+
+# How many appended blocks / seconds may pass before buffered writes are fsynced
+LEDGER_FSYNC_EVERY = int(os.environ.get("LEDGER_FSYNC_EVERY", "16"))
+LEDGER_FSYNC_INTERVAL = float(os.environ.get("LEDGER_FSYNC_INTERVAL", "1.0"))
+
+
+class LedgerFile:
+    """Append-only block storage with one compact JSON block per line
+
+    Appending a block writes a single line to the end of the file, so the
+    cost does not depend on how long the chain already is. Every append is
+    flushed to the OS straight away, while fsync is batched by block count
+    and elapsed time.
+    """
+
+    def __init__(self, path, fsync_every=None, fsync_interval=None):
+        self.path = path
+        self.fsync_every = LEDGER_FSYNC_EVERY if fsync_every is None else fsync_every
+        self.fsync_interval = LEDGER_FSYNC_INTERVAL if fsync_interval is None else fsync_interval
+
+        self._handle = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        # Writers from every process serialize on a lock file next to the ledger
+        self.lock_path = f"{path}.lock"
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_handle = None
+
+        # Identity of the file contents this instance has read or written so far,
+        # used to notice appends and rewrites made by other processes
+        self.offset = 0
+        self._inode = None
+        self._mtime_ns = None
+        self._close_at_exit = False
+
+    @contextmanager
+    def locked(self):
+        """Hold the exclusive writer lock for the ledger
+
+        Only one process at a time may append, so every writer must take
+        this lock, catch up with the file and then append. The lock is
+        re-entrant within a process.
+        """
+        with self._thread_lock:
+            if self._lock_depth == 0 and FILE_LOCKING_AVAILABLE:
+                self._lock_handle = open(self.lock_path, 'a')
+                fcntl.flock(self._lock_handle.fileno(), fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_handle is not None:
+                    fcntl.flock(self._lock_handle.fileno(), fcntl.LOCK_UN)
+                    self._lock_handle.close()
+                    self._lock_handle = None
+
+    def exists(self):
+        """Check whether the ledger file has been created"""
+        return os.path.exists(self.path)
+
+    @staticmethod
+    def _serialize(block):
+        """Encode a block as a single ledger line"""
+        return json.dumps(block, separators=(',', ':')) + '\n'
+
+    def read_blocks(self, offset=0):
+        """Read the blocks stored after the given byte offset
+
+        An incomplete trailing line is left unread; it is either a write that
+        is still in progress elsewhere or a torn append that gets repaired
+        before the next block is written.
+        """
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            f.seek(offset)
+            content = f.read()
+
+        end = content.rfind(b'\n') + 1
+        self.offset = offset + end
+        self._inode = st.st_ino
+        self._mtime_ns = st.st_mtime_ns
+
+        return [json.loads(line) for line in content[:end].splitlines() if line.strip()]
+
+    def poll(self):
+        """Check the file on disk against what this instance last saw
+
+        Returns None when nothing changed, 'appended' when new data follows
+        the last read position and 'rewritten' when the file was replaced or
+        shrunk and has to be read again from the start.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return 'rewritten'
+
+        if st.st_ino != self._inode or st.st_size < self.offset:
+            return 'rewritten'
+        if st.st_size > self.offset:
+            return 'appended'
+        if st.st_mtime_ns != self._mtime_ns:
+            return 'rewritten'
+        return None
+
+    def _open_for_append(self):
+        """Open the append handle, dropping a torn block left by a crash"""
+        with open(self.path, 'a+b') as f:
+            size = end = f.seek(0, os.SEEK_END)
+
+            # Walk back to the end of the last complete line
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline != -1:
+                    end = start + newline + 1
+                    break
+                end = start
+
+            if end < size:
+                logger.warning(f"Discarding {size - end} bytes of incomplete block at end of {self.path}")
+                f.truncate(end)
+
+        self._handle = open(self.path, 'a', encoding='utf-8')
+
+        # Make sure buffered blocks reach the disk on interpreter shutdown;
+        # read-only instances never open a handle and register nothing
+        if not self._close_at_exit:
+            atexit.register(self.close)
+            self._close_at_exit = True
+
+    def append(self, block):
+        """Append a single block to the end of the ledger
+
+        Callers sharing the ledger with other processes must hold locked().
+        """
+        if self._handle is not None and os.fstat(self._handle.fileno()).st_ino != self._path_inode():
+            # Another process replaced the file; appending to the old inode would lose the block
+            self.close()
+        if self._handle is None:
+            self._open_for_append()
+
+        line = self._serialize(block)
+        self._handle.write(line)
+        self._handle.flush()
+        self._unsynced += 1
+
+        # Our own write should not look like an outside change on the next poll
+        st = os.fstat(self._handle.fileno())
+        if st.st_size == self.offset + len(line.encode('utf-8')):
+            self.offset = st.st_size
+            self._inode = st.st_ino
+            self._mtime_ns = st.st_mtime_ns
+
+        # Batch fsync calls instead of paying for one per block
+        if (self._unsynced >= self.fsync_every or
+                time.monotonic() - self._last_sync >= self.fsync_interval):
+            self.sync()
+
+    def _path_inode(self):
+        """Inode currently at the ledger path, or None if there is none"""
+        try:
+            return os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def sync(self):
+        """Force appended blocks onto disk"""
+        if self._handle is not None and self._unsynced:
+            os.fsync(self._handle.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """Sync and close the append handle"""
+        if self._handle is not None:
+            self.sync()
+            self._handle.close()
+            self._handle = None
+
+    def write_all(self, blocks):
+        """Atomically replace the ledger with the given blocks"""
+        self.close()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for block in blocks:
+                f.write(self._serialize(block))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        st = os.stat(self.path)
+        self.offset = st.st_size
+        self._inode = st.st_ino
+        self._mtime_ns = st.st_mtime_ns
+
+
+def migrate_json_chain(json_path, ledger):
+    """Convert a legacy blockchain.json array into the append-only ledger
+
+    The legacy file is renamed with a ``.migrated`` suffix once the ledger
+    has been written, so it is kept around but never read again.
+    """
+    with open(json_path, 'r') as f:
+        chain = json.load(f)
+
+    ledger.write_all(chain)
+    os.replace(json_path, f"{json_path}.migrated")
+
+    logger.info(f"Migrated {len(chain)} blocks from {json_path} to {ledger.path}")
+    return chain
@@ -0,0 +1,120 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Run concurrent single-item requests as batches on one worker thread
+
+    submit() queues an item and returns a Future. The worker takes the first
+    waiting item, keeps collecting until max_batch_size items are queued or
+    max_wait_ms has passed since that item arrived, then hands the whole
+    batch to handler, which returns one result per item in order. Items that
+    arrive while a batch is running are picked up together by the next one,
+    so under load batches grow without any extra waiting.
+    """
+
+    def __init__(self, name, handler, max_batch_size=64, max_wait_ms=2.0):
+        self.name = name
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        # Throughput counters
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.queue_seconds = 0.0
+        self.handler_seconds = 0.0
+        self.errors = 0
+
+    def _ensure_started(self):
+        # Started on first use, and again in a forked worker, which inherits no threads
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        """Queue an item for the next batch and return a Future of its result"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future
+
+    def _collect(self):
+        """Block for the first item, then gather a batch around it"""
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            items = [item for item, _, _ in batch]
+            try:
+                results = self.handler(items)
+                if len(results) != len(items):
+                    raise ValueError(f"{self.name} handler returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                logger.error(f"{self.name} batch of {len(items)} failed: {str(e)}")
+                with self._lock:
+                    self.errors += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.queue_seconds += sum(started - queued for _, _, queued in batch)
+                self.handler_seconds += time.monotonic() - started
+
+    def stats(self):
+        """Return batching configuration and throughput counters"""
+        with self._lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'queued': self._queue.qsize(),
+                'batches': self.batches,
+                'items': self.items,
+                'avg_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0,
+                'largest_batch': self.largest_batch,
+                'avg_queue_ms': round(self.queue_seconds / self.items * 1000, 3) if self.items else 0.0,
+                'avg_batch_ms': round(self.handler_seconds / self.batches * 1000, 3) if self.batches else 0.0,
+                'errors': self.errors
+            }
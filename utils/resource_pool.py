@@ -0,0 +1,106 @@
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Instances per pool and how long a request may wait for one
+FACE_POOL_SIZE = int(os.environ.get("FACE_POOL_SIZE", "0")) or os.cpu_count() or 1
+FACE_POOL_TIMEOUT = float(os.environ.get("FACE_POOL_TIMEOUT", "5.0"))
+
+
+class PoolTimeout(RuntimeError):
+    """No pooled instance became free within the checkout timeout"""
+
+
+class ResourcePool:
+    """Bounded pool of objects that must not be shared between threads
+
+    Instances are created lazily by factory up to size. A checkout takes an
+    idle instance, or waits up to timeout seconds for one to be returned.
+    """
+
+    def __init__(self, name, factory, size=None, timeout=None):
+        self.name = name
+        self.factory = factory
+        self.size = size or FACE_POOL_SIZE
+        self.timeout = FACE_POOL_TIMEOUT if timeout is None else timeout
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+
+        # Utilization counters
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _acquire(self):
+        # Reuse an idle instance, or create one while below the size limit
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Every instance is checked out, wait for one to come back
+        started = time.monotonic()
+        try:
+            instance = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"No {self.name} instance free after {self.timeout}s")
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += time.monotonic() - started
+        return instance
+
+    @contextmanager
+    def checkout(self):
+        """Borrow an instance for the duration of the with block"""
+        instance = self._acquire()
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        try:
+            yield instance
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._idle.put(instance)
+
+    def stats(self):
+        """Return pool size and utilization counters"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self.in_use,
+                'idle': self._idle.qsize(),
+                'peak_in_use': self.peak_in_use,
+                'utilization': round(self.in_use / self.size, 3),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait_ms': round(self.wait_seconds / self.waits * 1000, 3) if self.waits else 0.0,
+                'timeouts': self.timeouts
+            }